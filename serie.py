@@ -1,8 +1,41 @@
 #!/usr/bin/env python
 import os
 import re
+import select
+import struct
+import ctypes
+import ctypes.util
+import contextlib
+import json
+import csv
+import hashlib
+import ast
+import io
+import zlib
+import shlex
 import sys
 import stat
+import time
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+try :
+    import fcntl
+except ImportError :
+    fcntl = None
+    import msvcrt
+try :
+    from shlex import quote
+except ImportError :
+    from pipes import quote
+try :
+    from os import scandir as os_scandir
+except ImportError :
+    try :
+        # The scandir backport, on Python 2.
+        from scandir import scandir as os_scandir
+    except ImportError :
+        os_scandir = None
 
 class SerieState(object) :
     NONE = 0
@@ -10,6 +43,392 @@ class SerieState(object) :
     SEEN = 2
     GOTSEEN = 3
 
+class Interval(object) :
+    # Inclusive range of episode numbers.
+    __slots__ = ('start', 'end')
+
+    def __init__(self, start, end) :
+        if end < start :
+            start, end = end, start
+        self.start = start
+        self.end = end
+
+    def __eq__(self, other) :
+        return isinstance(other, Interval) and (self.start, self.end) == (other.start, other.end)
+
+    def __ne__(self, other) :
+        return not self == other
+
+    def __repr__(self) :
+        return 'Interval(%d, %d)' % (self.start, self.end)
+
+class NamespaceState(object) :
+    # Episode states of a namespace, one SerieState byte per episode number
+    # (index 0 is unused). The array only grows up to the highest episode
+    # number ever set, even to NONE, which is what highest() returns.
+    # counts[state] is the number of episodes in each state, kept up to
+    # date on every change, so the aggregates below never walk states.
+    # version is bumped on every change of states.
+    __slots__ = ('states', 'max', 'subdir', 'counts', 'version')
+
+    _STATE_BYTES = [bytes(bytearray([state])) for state in range(4)]
+
+    # bytearray.translate tables applying "| state" or "& ~state" to every
+    # byte of a range at once, by (state, add).
+    _TABLES = {}
+
+    @classmethod
+    def _table(cls, state, add) :
+        key = (state, add)
+        if key not in cls._TABLES :
+            if add :
+                values = [value | state for value in range(256)]
+            else :
+                values = [value & ~state for value in range(256)]
+            cls._TABLES[key] = bytes(bytearray(values))
+        return cls._TABLES[key]
+
+    def __init__(self) :
+        self.states = bytearray()
+        self.max = None
+        self.subdir = None
+        self.counts = [0, 0, 0, 0]
+        self.version = 0
+
+    def _grow(self, num) :
+        if num >= len(self.states) :
+            self.counts[SerieState.NONE] += num + 1 - len(self.states)
+            self.states.extend(bytearray(num + 1 - len(self.states)))
+
+    def _count(self, states, sign) :
+        for state in range(4) :
+            self.counts[state] += sign * states.count(self._STATE_BYTES[state])
+
+    def set_states(self, states) :
+        self.version += 1
+        self.states = bytearray(states)
+        self.counts = [0, 0, 0, 0]
+        self._count(self.states, 1)
+
+    def get(self, num) :
+        if num < len(self.states) :
+            return self.states[num]
+        return SerieState.NONE
+
+    def add(self, num, state) :
+        self._set(num, self.get(num) | state)
+
+    def remove(self, num, state) :
+        self._set(num, self.get(num) & ~state)
+
+    def _set(self, num, state) :
+        self.version += 1
+        self._grow(num)
+        self.counts[self.states[num]] -= 1
+        self.counts[state] += 1
+        self.states[num] = state
+
+    def add_run(self, start, states) :
+        # Adds states (a bytearray) to the episodes from start on. Faster
+        # than add for each episode when they were all NONE, as in a scan.
+        end = start + len(states) - 1
+        self.version += 1
+        self._grow(end)
+        old_states = self.states[start:end+1]
+        if old_states.count(self._STATE_BYTES[SerieState.NONE]) == len(old_states) :
+            self.counts[SerieState.NONE] -= len(states)
+            self._count(states, 1)
+            self.states[start:end+1] = states
+        else :
+            for offset, state in enumerate(states) :
+                self.add(start + offset, state)
+
+    def add_range(self, interval, state) :
+        self._apply_range(interval, self._table(state, True))
+
+    def remove_range(self, interval, state) :
+        self._apply_range(interval, self._table(state, False))
+
+    def _apply_range(self, interval, table) :
+        self.version += 1
+        self._grow(interval.end)
+        old_states = self.states[interval.start:interval.end+1]
+        new_states = old_states.translate(table)
+        self._count(old_states, -1)
+        self._count(new_states, 1)
+        self.states[interval.start:interval.end+1] = new_states
+
+    RUN_RE = re.compile(b'\x00+|\x01+|\x02+|\x03+')
+
+    def runs(self, start, end) :
+        # Yields (run_start, run_end, state) for each run of episodes sharing
+        # the same state between start and end (both included).
+        limit = min(end, len(self.states) - 1)
+        tail_start = max(start, limit + 1)
+        if start <= limit :
+            for match in self.RUN_RE.finditer(bytes(self.states[start:limit+1])) :
+                run_start = start + match.start()
+                run_end = start + match.end() - 1
+                state = self.states[run_start]
+                if state == SerieState.NONE and run_end == limit and limit < end :
+                    # Merged with the NONE episodes past the array.
+                    tail_start = run_start
+                    break
+                yield (run_start, run_end, state)
+        if tail_start <= end :
+            yield (tail_start, end, SerieState.NONE)
+
+    def clear(self) :
+        self.version += 1
+        self.states = bytearray()
+        self.max = None
+        self.counts = [0, 0, 0, 0]
+
+    def highest(self) :
+        if len(self.states) > 1 :
+            return len(self.states) - 1
+        return None
+
+    def got(self) :
+        return self.counts[SerieState.GOT] + self.counts[SerieState.GOTSEEN]
+
+    def seen(self) :
+        return self.counts[SerieState.SEEN] + self.counts[SerieState.GOTSEEN]
+
+    def got_not_seen(self) :
+        return self.counts[SerieState.GOT]
+
+    def is_complete(self) :
+        # Every episode up to max is got.
+        if self.max is None :
+            return False
+        got = self.got()
+        if len(self.states) > self.max + 1 :
+            got -= sum(1 for state in self.states[self.max+1:] if state & SerieState.GOT)
+        if len(self.states) > 0 and self.states[0] & SerieState.GOT :
+            got -= 1
+        return got == self.max
+
+class NamespaceRegistry(object) :
+    # The NamespaceState of every namespace, with the namespaces linked to
+    # each subdir and the sorted names, kept up to date on insert.
+    def __init__(self) :
+        self._states = {}
+        self._by_subdir = {}
+        self._names = None
+
+    def __contains__(self, namespace) :
+        return namespace in self._states
+
+    def __getitem__(self, namespace) :
+        return self._states[namespace]
+
+    def __len__(self) :
+        return len(self._states)
+
+    def get(self, namespace) :
+        return self._states.get(namespace)
+
+    def add(self, namespace) :
+        namespace_state = NamespaceState()
+        self._states[namespace] = namespace_state
+        self._names = None
+        return namespace_state
+
+    def names(self) :
+        if self._names is None :
+            self._names = sorted(self._states.keys())
+        return self._names
+
+    def values(self) :
+        return self._states.values()
+
+    def items(self) :
+        return [(namespace, self._states[namespace]) for namespace in self.names()]
+
+    def parent(self, namespace) :
+        # 'a' for 'a_b', '' for 'a', None for ''.
+        if namespace == '' :
+            return None
+        return namespace.rpartition('_')[0]
+
+    def set_subdir(self, namespace, subdir) :
+        namespace_state = self._states[namespace]
+        if namespace_state.subdir is not None :
+            namespaces = self._by_subdir[namespace_state.subdir]
+            namespaces.discard(namespace)
+            if len(namespaces) == 0 :
+                del self._by_subdir[namespace_state.subdir]
+        namespace_state.subdir = subdir
+        if subdir is not None :
+            self._by_subdir.setdefault(subdir, set()).add(namespace)
+
+    def get_by_subdir(self, subdir) :
+        # The first namespace in sorted order when several share subdir.
+        namespaces = self._by_subdir.get(subdir)
+        if not namespaces :
+            return None
+        return min(namespaces)
+
+class LruCache(object) :
+    # Bounded memo approximating least recently used eviction with two
+    # generations of plain dicts : hits in the old generation are moved to
+    # the recent one, and when the recent one is full, the old one is
+    # dropped. Dict operations are atomic, so it can be used by scan threads.
+    def __init__(self, size) :
+        self._size = max(1, size // 2)
+        self._recent = {}
+        self._old = {}
+
+    def get(self, key, default=None) :
+        value = self._recent.get(key, default)
+        if value is default :
+            value = self._old.get(key, default)
+            if value is not default :
+                self.set(key, value)
+        return value
+
+    def set(self, key, value) :
+        if len(self._recent) >= self._size :
+            self._old = self._recent
+            self._recent = {}
+        self._recent[key] = value
+
+    def __len__(self) :
+        return len(self._recent) + len(self._old)
+
+class MarkerToken(object) :
+    # A parsed marker filename. namespace is the raw namespace written in the
+    # filename ('' if none), items a tuple of (num, SerieState), and ranges
+    # a tuple of (start, end, SerieState) for the [start..end] items of the
+    # compact syntax. When items are following episodes and there is no
+    # range, start is the first one and states a bytearray of their states
+    # (start is None otherwise) : items is then only built when asked for.
+    __slots__ = ('new_syntax', 'namespace', 'has_max', 'ranges', 'start', 'states', '_items', '_width')
+
+    def __init__(self, new_syntax, namespace, items, has_max, ranges=(), start=None, states=None, width=None) :
+        self.new_syntax = new_syntax
+        self.namespace = namespace
+        self.has_max = has_max
+        self.ranges = ranges
+        self.start = start
+        self.states = states
+        self._items = items
+        self._width = width
+
+    @property
+    def items(self) :
+        if self._items is None :
+            self._items = tuple(zip(range(self.start, self.start + len(self.states)), self.states))
+        return self._items
+
+    def first(self) :
+        # The lowest episode number of the marker.
+        if self.start is not None :
+            return self.start
+        return min([num for num, state in self.items] + [start for start, end, state in self.ranges])
+
+    def last(self) :
+        # The highest episode number of the items.
+        if self.start is not None :
+            return self.start + len(self.states) - 1
+        return max(num for num, state in self.items)
+
+    def width(self) :
+        # The number of digits of every item when they are written the way
+        # Serie writes them (following numbers, same width, matching closing
+        # chars), None otherwise.
+        return self._width
+
+class MarkerTokenizer(object) :
+    # Parses marker filenames (@_ or @: prefix, namespace, [n] -n- !n! $n$
+    # items or [n..m] -n..m- !n..m! $n..m$ ranges, + or # suffix) with one
+    # match of MARKER_RE. Markers as Serie writes them are then checked
+    # against the items expected from their first one and their width,
+    # without going through them one by one, other ones are split into
+    # items. The last MEMO_SIZE filenames and namespace names seen are
+    # remembered.
+    MARKER_RE = re.compile(r'^(\@[\:\_])?([^\[\]\$\!\@\:\~0-9][^\[\]\$\!\@\:\~]*_)?((?:[\[\-\$\!]([0-9]+)(?:\.\.[0-9]+)?[\]\-\$\!])+)([\+\#])?$')
+    ITEM_RE = re.compile(r'([\[\-\$\!])([0-9]+)(?:\.\.([0-9]+))?[\]\-\$\!]')
+    ITEM_STATES = {'-' : SerieState.NONE, '[' : SerieState.GOT, '!' : SerieState.SEEN, '$' : SerieState.GOTSEEN}
+    # str.translate tables : state chars to '-', '[' to its closing char,
+    # opening chars to their SerieState.
+    NORMALIZE_TABLE = ''.join('-' if chr(code) in '[]!$' else chr(code) for code in range(256))
+    CLOSE_TABLE = ''.join(']' if chr(code) == '[' else chr(code) for code in range(256))
+    STATE_TABLE = ''.join(chr('-[!$'.index(chr(code))) if chr(code) in '-[!$' else chr(code) for code in range(256))
+    NAMESPACE_WITH_NUM_RE = re.compile(r'^(.*?)([0-9]+)$')
+    MEMO_SIZE = 65536
+
+    def __init__(self) :
+        self._markers = LruCache(self.MEMO_SIZE)
+        self._namespaces = LruCache(self.MEMO_SIZE)
+        # Normalized items text, by (first episode, count, width).
+        self._runs = LruCache(self.MEMO_SIZE)
+
+    def parse(self, filename) :
+        # Returns a MarkerToken, or None if filename is not a marker.
+        token = self._markers.get(filename, False)
+        if token is False :
+            token = self._parse(filename)
+            self._markers.set(filename, token)
+        return token
+
+    def _parse(self, filename) :
+        match = self.MARKER_RE.match(filename)
+        if match is None :
+            return None
+        # As written before namespaces existed : the namespace is whatever
+        # lies between the first and the last '_'.
+        first_underscore = filename.find('_')
+        last_underscore = filename.rfind('_')
+        namespace = ''
+        if first_underscore != last_underscore :
+            namespace = filename[first_underscore+1:last_underscore]
+        new_syntax = filename.startswith('@')
+        has_max = match.group(5) is not None
+        text = match.group(3)
+        # The width of the last item, which all items have when written
+        # by Serie.
+        width = len(match.group(4))
+        step = width + 2
+        count = len(text) // step
+        start = text[1:step-1]
+        if count * step == len(text) and start.isdigit() :
+            start = int(start)
+            key = (start, count, width)
+            expected = self._runs.get(key)
+            if expected is None :
+                expected = ''.join(['-%0*d-' % (width, num) for num in range(start, start + count)])
+                self._runs.set(key, expected)
+            opens = text[::step]
+            if text.translate(self.NORMALIZE_TABLE) == expected and text[step-1::step] == opens.translate(self.CLOSE_TABLE) :
+                return MarkerToken(new_syntax, namespace, None, has_max, (), start, bytearray(opens.translate(self.STATE_TABLE)), width)
+        item_states = self.ITEM_STATES
+        items = []
+        ranges = []
+        for state, num, end in self.ITEM_RE.findall(text) :
+            if end == '' :
+                items.append((int(num), item_states[state]))
+            else :
+                ranges.append((int(num), int(end), item_states[state]))
+        if len(ranges) == 0 and [num for num, state in items] == list(range(items[0][0], items[0][0] + len(items))) :
+            # Following episodes, not all of the same width.
+            return MarkerToken(new_syntax, namespace, tuple(items), has_max, (), items[0][0], bytearray([state for num, state in items]))
+        return MarkerToken(new_syntax, namespace, tuple(items), has_max, tuple(ranges))
+
+    def normalize_namespace(self, namespace) :
+        normalized = self._namespaces.get(namespace)
+        if normalized is None :
+            normalized = namespace.replace(':','_')
+            if normalized.endswith('_') :
+                raise Exception('No!')
+            namespace_num_match = self.NAMESPACE_WITH_NUM_RE.match(normalized)
+            if namespace_num_match is not None:
+                prefix, count = namespace_num_match.groups()
+                normalized = prefix+"%02d" % (int(count),)
+            self._namespaces.set(namespace, normalized)
+        return normalized
+
 class ConsoleExporter(object) :
     def out(self, text) :
         sys.stdout.write(text+'\n')
@@ -20,57 +439,1358 @@ class ConsoleExporter(object) :
     def debug(self, text) :
         sys.stdout.write(text+'\n')
 
+class BufferedConsole(object) :
+    # Keeps the lines of a Serie running in a worker process, to be
+    # replayed on the real console by the parent.
+    def __init__(self) :
+        self.lines = []
+
+    def out(self, text) :
+        self.lines.append(('out', text))
+
+    def err(self, text) :
+        self.lines.append(('err', text))
+
+    def debug(self, text) :
+        pass
+
+    def replay(self, console, prefix='') :
+        for kind, text in self.lines :
+            if kind == 'err' :
+                console.err(prefix + text)
+            else :
+                console.out(prefix + text)
+
+class SerieOsEntry(object) :
+    __slots__ = ('name', 'path', '_dir_entry', '_size', '_mode')
+
+    def __init__(self, name, path, dir_entry=None, size=None, mode=None) :
+        self.name = name
+        self.path = path
+        self._dir_entry = dir_entry
+        self._size = size
+        self._mode = mode
+
+    def _lstat(self) :
+        if self._dir_entry is not None :
+            stat_result = self._dir_entry.stat(follow_symlinks=False)
+        else :
+            stat_result = os.lstat(self.path)
+        self._size = stat_result.st_size
+        self._mode = stat.S_IMODE(stat_result.st_mode)
+
+    def size(self) :
+        if self._size is None :
+            self._lstat()
+        return self._size
+
+    def mode(self) :
+        if self._mode is None :
+            self._lstat()
+        return self._mode
+
+class InotifyWatcher(object) :
+    # Linux only : reports the names created, deleted or renamed in the
+    # watched directories, through inotify called with ctypes.
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+    EVENT = struct.Struct('iIII')
+    # Once an event arrived, waits that long for more events to batch them.
+    DELAY = 0.2
+
+    def __init__(self) :
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(self._libc, 'inotify_init') :
+            raise OSError('inotify is not available')
+        self._fd = self._libc.inotify_init()
+        if self._fd < 0 :
+            raise OSError(ctypes.get_errno(), 'inotify_init')
+        self._dirs = {}
+
+    def add(self, dirname) :
+        path = dirname
+        if not isinstance(path, bytes) :
+            path = path.encode(sys.getfilesystemencoding())
+        wd = self._libc.inotify_add_watch(self._fd, path, self.MASK)
+        if wd >= 0 :
+            self._dirs[wd] = dirname
+
+    def wait(self) :
+        # Blocks until something happens, returns a set of (dirname, name).
+        events = set()
+        timeout = None
+        while True :
+            ready, _, _ = select.select([self._fd], [], [], timeout)
+            if len(ready) == 0 :
+                return events
+            data = os.read(self._fd, 65536)
+            offset = 0
+            while offset < len(data) :
+                wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                name = data[offset:offset+length].rstrip(b'\0')
+                offset += length
+                if wd in self._dirs and len(name) > 0 :
+                    if not isinstance(name, str) :
+                        name = name.decode(sys.getfilesystemencoding())
+                    events.add((self._dirs[wd], name))
+            timeout = self.DELAY
+
+    def close(self) :
+        os.close(self._fd)
+
 class SerieOs(object) :
+    # Paths are relative to root (the current directory by default).
+    # Serie may run the roots of --root in other processes.
+    multiprocess = True
+
+    def __init__(self, root=None) :
+        self._root = root
+    def _path(self, filename) :
+        if self._root is None :
+            return filename
+        return os.path.join(self._root, filename)
+    def for_root(self, root) :
+        return SerieOs(self._path(root))
+    def scandir(self, dirname) :
+        # Entries are yielded as soon as they are read, and only stat'ed
+        # when size() or mode() is called on them (once per entry).
+        dirname = self._path(dirname)
+        if os_scandir is not None :
+            for dir_entry in os_scandir(dirname) :
+                yield SerieOsEntry(dir_entry.name, dir_entry.path, dir_entry)
+        else :
+            for filename in os.listdir(dirname) :
+                yield SerieOsEntry(filename, os.path.join(dirname, filename))
     def listdir(self, dirname) :
-        return os.listdir(dirname)
+        return os.listdir(self._path(dirname))
     def filesize(self, filename) :
-        return os.lstat(filename).st_size
+        return os.lstat(self._path(filename)).st_size
     def touch(self, filename) :
         #basedir = os.path.basedir(filename)
         #if basedir != '' and not os.exists(basedir) :
         #    os.makedirs(dirname, 0777)
-        handle = open(filename,'wb')
+        handle = open(self._path(filename),'wb')
         handle.close()
         self.remove_exec(filename)
     def unlink(self, filename) :
-        os.unlink(filename)
-    def remove_exec(self, filename) :
+        os.unlink(self._path(filename))
+    def remove_exec(self, filename, mode=None) :
         S_IX=(stat.S_IXUSR|stat.S_IXGRP|stat.S_IXOTH)
-        mode = stat.S_IMODE(os.lstat(filename).st_mode)
+        filename = self._path(filename)
+        if mode is None :
+            mode = stat.S_IMODE(os.lstat(filename).st_mode)
         if (mode & S_IX != 0) :
             os.chmod(filename, mode &~S_IX)
     def open(self, filename) :
-        return open(filename, 'wb')
+        return open(self._path(filename), 'wb')
     def fileexists(self, filename) :
-        return os.path.exists(filename)
+        return os.path.exists(self._path(filename))
+    def read(self, filename) :
+        if filename == '-' :
+            return sys.stdin.read()
+        try :
+            with open(self._path(filename), 'rb') as handle :
+                return handle.read()
+        except (IOError, OSError) :
+            return None
+    def dirstat(self, dirname) :
+        try :
+            stat_result = os.stat(self._path(dirname))
+        except OSError :
+            return None
+        return (stat_result.st_mtime, stat_result.st_ino)
+    def rename(self, filename, new_filename) :
+        filename, new_filename = self._path(filename), self._path(new_filename)
+        try :
+            os.rename(filename, new_filename)
+        except OSError :
+            # Windows does not rename over an existing file.
+            if not os.path.exists(new_filename) :
+                raise
+            os.unlink(new_filename)
+            os.rename(filename, new_filename)
+    def watcher(self) :
+        return InotifyWatcher()
     def mkdir(self, dirname) :
+        dirname = self._path(dirname)
         if not os.path.exists(dirname) :
-            os.makedirs(dirname, 0777)
+            os.makedirs(dirname, 0o777)
+    def _lock_handle(self, handle, blocking) :
+        # Raises IOError (or OSError) if not blocking and already locked.
+        if fcntl is not None :
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else :
+            handle.seek(0)
+            msvcrt.locking(handle.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+    def lock(self, filename) :
+        # Returns a handle holding the lock of filename, or None if another
+        # process holds it. The lock goes away with the process, so a
+        # crashed leader never leaves a stale one.
+        handle = open(self._path(filename), 'ab')
+        try :
+            self._lock_handle(handle, False)
+        except (IOError, OSError) :
+            handle.close()
+            return None
+        return handle
+    def unlock(self, handle) :
+        handle.close()
+    def append(self, filename, data) :
+        with open(self._path(filename), 'ab') as handle :
+            self._lock_handle(handle, True)
+            handle.write(data)
+    def read_locked(self, filename) :
+        # Returns the content of filename, under the same lock as append so
+        # that no line is read half written.
+        try :
+            handle = open(self._path(filename), 'rb')
+        except (IOError, OSError) :
+            return ''
+        with handle :
+            self._lock_handle(handle, True)
+            return handle.read()
+    def drop(self, filename, size) :
+        # Removes the first size bytes of filename, keeping what was
+        # appended since it was read.
+        with open(self._path(filename), 'r+b') as handle :
+            self._lock_handle(handle, True)
+            content = handle.read()
+            handle.seek(0)
+            handle.write(content[size:])
+            handle.truncate()
+
+class SerieStats(object) :
+    # Wall and CPU time spent in each phase, and counters, as reported
+    # by --stats.
+    cpu_time = getattr(time, 'process_time', None) or time.clock
+
+    def __init__(self) :
+        self.phases = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name) :
+        wall_start, cpu_start = time.time(), self.cpu_time()
+        try :
+            yield
+        finally :
+            timings = self.phases.setdefault(name, {'wall' : 0.0, 'cpu' : 0.0})
+            timings['wall'] += time.time() - wall_start
+            timings['cpu'] += self.cpu_time() - cpu_start
+
+    def count(self, name, value=1) :
+        # SerieOs calls may come from several threads.
+        with self._lock :
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self) :
+        return json.dumps({'phases' : self.phases, 'counters' : self.counters}, sort_keys=True)
+
+class CountingEntry(object) :
+    # A SerieOsEntry of CountingSerieOs.scandir, counting its lstat (done
+    # once, by the first size() or mode() call) as os.lstat.
+    __slots__ = ('name', 'path', '_stats', '_entry', '_counted')
+
+    def __init__(self, stats, entry) :
+        self.name = entry.name
+        self.path = entry.path
+        self._stats = stats
+        self._entry = entry
+        self._counted = False
+
+    def _count(self) :
+        if not self._counted :
+            self._counted = True
+            self._stats.count('os.lstat')
+
+    def size(self) :
+        self._count()
+        return self._entry.size()
+
+    def mode(self) :
+        self._count()
+        return self._entry.mode()
+
+class CountingSerieOs(object) :
+    # Wraps a SerieOs, counting the calls of each method as os.<method>,
+    # and the lstat of scandir entries as os.lstat.
+    def __init__(self, serieos, stats) :
+        self._serieos = serieos
+        self._stats = stats
+
+    def __getattr__(self, name) :
+        method = getattr(self._serieos, name)
+        if not callable(method) :
+            return method
+        def counted(*args, **kwargs) :
+            self._stats.count('os.' + name)
+            return method(*args, **kwargs)
+        return counted
+
+    def scandir(self, dirname) :
+        self._stats.count('os.scandir')
+        for entry in self._serieos.scandir(dirname) :
+            yield CountingEntry(self._stats, entry)
+
+class RecordingEntry(object) :
+    # A SerieOsEntry of RecordingSerieOs.scandir, recording its lstat.
+    __slots__ = ('name', 'path', '_recorder', '_entry')
+
+    def __init__(self, recorder, entry) :
+        self.name = entry.name
+        self.path = entry.path
+        self._recorder = recorder
+        self._entry = entry
+
+    def size(self) :
+        return self._recorder.call('size', lambda path : self._entry.size(), (self.path,))
+
+    def mode(self) :
+        return self._recorder.call('mode', lambda path : self._entry.mode(), (self.path,))
+
+class RecordingSerieOs(object) :
+    # Wraps a SerieOs, recording every call with its start time, latency
+    # and result (or error), for ReplayingSerieOs. save() writes the trace :
+    # zlib compressed lines holding the repr of a header, then of one
+    #   (time, latency, root, name, args, result, error)
+    # tuple per call. Roots are run in threads to be recorded too.
+    VERSION = 1
+    multiprocess = False
+
+    def __init__(self, serieos, argv, root=None, events=None) :
+        self._serieos = serieos
+        self._argv = list(argv)
+        self._root = root
+        self._events = [] if events is None else events
+        self._start = time.time()
+
+    @staticmethod
+    def literal(value) :
+        # value if repr/ast.literal_eval keep it as is, None otherwise.
+        if value is None or isinstance(value, (str, bytes, type(u''), bool, int, float)) :
+            return value
+        if isinstance(value, (list, tuple)) :
+            return type(value)(RecordingSerieOs.literal(item) for item in value)
+        return None
+
+    def call(self, name, method, args, record=None) :
+        # record gives what the trace keeps of the result.
+        start = time.time()
+        try :
+            result = method(*args)
+        except (IOError, OSError) as exception :
+            self._events.append((start - self._start, time.time() - start, self._root, name, self.literal(args), None, (exception.errno, exception.strerror or str(exception))))
+            raise
+        recorded = result if record is None else record(result)
+        self._events.append((start - self._start, time.time() - start, self._root, name, self.literal(args), self.literal(recorded), None))
+        return result
+
+    def __getattr__(self, name) :
+        method = getattr(self._serieos, name)
+        if not callable(method) or name == 'watcher' :
+            return method
+        def recorded(*args) :
+            return self.call(name, method, args)
+        return recorded
+
+    def scandir(self, dirname) :
+        entries = self.call('scandir', lambda dirname : list(self._serieos.scandir(dirname)), (dirname,), lambda entries : [(entry.name, entry.path) for entry in entries])
+        for entry in entries :
+            yield RecordingEntry(self, entry)
+
+    def lock(self, filename) :
+        return self.call('lock', self._serieos.lock, (filename,), lambda handle : handle is not None)
+
+    def for_root(self, root) :
+        return RecordingSerieOs(self._serieos.for_root(root), self._argv, root, self._events)
+
+    def save(self, filename) :
+        lines = [repr({'version' : self.VERSION, 'argv' : self._argv})]
+        lines += [repr(event) for event in sorted(self._events, key=lambda event : event[0])]
+        content = '\n'.join(lines)
+        if not isinstance(content, bytes) :
+            content = content.encode('utf-8')
+        with self._serieos.open(filename) as handle :
+            handle.write(zlib.compress(content))
+
+class ReplayingEntry(SerieOsEntry) :
+    # A SerieOsEntry of ReplayingSerieOs.scandir, its lstat read in the
+    # trace. Entries never lstat'ed when recorded are not markers.
+    __slots__ = ('_replayer',)
+
+    def __init__(self, replayer, name, path) :
+        SerieOsEntry.__init__(self, name, path)
+        self._replayer = replayer
+
+    def size(self) :
+        return self._replayer.call('size', self.path, default=1)
+
+    def mode(self) :
+        return self._replayer.call('mode', self.path, default=0o644)
+
+class ReplayingSerieOs(object) :
+    # Answers the calls of Serie with the results of a RecordingSerieOs
+    # trace, in memory : nothing is read from or written to the disk. With
+    # latency, each call takes as long as it took when recorded, else the
+    # trace is replayed as fast as possible. A call that is not in the trace
+    # raises ValueError. Calls made more often than recorded get the last
+    # recorded result.
+    multiprocess = False
+
+    def __init__(self, trace, latency=False, root=None, calls=None) :
+        self.argv = []
+        self._latency = latency
+        self._root = root
+        self._lock = threading.Lock()
+        if calls is None :
+            calls = {}
+            content = zlib.decompress(trace)
+            if not isinstance(content, str) :
+                content = content.decode('utf-8')
+            lines = content.split('\n')
+            header = ast.literal_eval(lines[0])
+            if header.get('version') != RecordingSerieOs.VERSION :
+                raise ValueError('unknown trace version %r' % (header.get('version'),))
+            self.argv = header['argv']
+            for line in lines[1:] :
+                start, latency_value, root_name, name, args, result, error = ast.literal_eval(line)
+                calls.setdefault((root_name, name, args), []).append((latency_value, result, error))
+        self._calls = calls
+
+    def call(self, name, *args, **kwargs) :
+        key = (self._root, name, RecordingSerieOs.literal(args))
+        with self._lock :
+            calls = self._calls.get(key)
+            if not calls :
+                if 'default' in kwargs :
+                    return kwargs['default']
+                raise ValueError('%s%r is not in the trace' % (name, args))
+            latency, result, error = calls.pop(0) if len(calls) > 1 else calls[0]
+        if self._latency :
+            time.sleep(latency)
+        if error is not None :
+            raise OSError(*error)
+        return result
+
+    def __getattr__(self, name) :
+        def replayed(*args) :
+            return self.call(name, *args)
+        return replayed
+
+    def scandir(self, dirname) :
+        for name, path in self.call('scandir', dirname) :
+            yield ReplayingEntry(self, name, path)
+
+    def open(self, filename) :
+        self.call('open', filename)
+        return io.BytesIO()
+
+    def lock(self, filename) :
+        if self.call('lock', filename) :
+            return filename
+        return None
+
+    def watcher(self) :
+        raise OSError('a trace can not be watched')
+
+    def for_root(self, root) :
+        return ReplayingSerieOs(None, self._latency, root, self._calls)
+
+class SerieCache(object) :
+    # On disk index of the markers found in each scanned directory, keyed by
+    # the directory mtime and inode. A line based format is used :
+    #   D <mtime> <ino> <dirname>
+    #   M <mode> <marker filename>   (markers of the previous D line)
+    #   N <name>                     (linked subdir present in the directory)
+    # Modes are the ones of the scan that stored them : a chmod does not
+    # change the directory mtime, and is only seen once it changed.
+    FILENAME = '.serie-cache'
+    HEADER = 'serie-cache 1'
+    # Directories modified less than RACY_DELAY seconds before saving are not
+    # stored, as a later change could happen without changing their mtime.
+    # When mtimes have a fraction of second, as the one of the root after
+    # the reports are written, waiting SUBSECOND_RACY_DELAY is enough, the
+    # directory being listed again to check it still holds the markers.
+    RACY_DELAY = 2
+    SUBSECOND_RACY_DELAY = 0.02
+
+    def __init__(self, serieos, is_marker) :
+        self._serieos = serieos
+        self._is_marker = is_marker
+        self._dirs = {}
+
+    def load(self) :
+        self._dirs = {}
+        content = self._serieos.read(self.FILENAME)
+        if content is None :
+            return False
+        lines = content.split('\n')
+        if lines[0] != self.HEADER :
+            return False
+        current = None
+        try :
+            for line in lines[1:] :
+                if line == '' :
+                    continue
+                kind, data = line.split(' ', 1)
+                if kind == 'D' :
+                    mtime, ino, dirname = data.split(' ', 2)
+                    current = ([], [])
+                    self._dirs[dirname] = ((float(mtime), int(ino)), current)
+                elif kind == 'M' :
+                    mode, filename = data.split(' ', 1)
+                    current[0].append((filename, int(mode)))
+                elif kind == 'N' :
+                    current[1].append(data)
+                else :
+                    raise ValueError(kind)
+        except (ValueError, TypeError) :
+            self._dirs = {}
+            return False
+        return True
+
+    def get(self, dirname) :
+        # Returns the (markers, names) stored for dirname if it did not
+        # change since, None otherwise.
+        if dirname not in self._dirs :
+            return None
+        dirstat, cached = self._dirs[dirname]
+        if self._serieos.dirstat(dirname) != dirstat :
+            return None
+        return cached
+
+    def set(self, dirname, markers, names) :
+        dirstat = self._serieos.dirstat(dirname)
+        if dirstat is not None and dirstat[0] > time.time() - self.RACY_DELAY :
+            dirstat = self.settle(dirname, dirstat, markers)
+        if dirstat is None :
+            self._dirs.pop(dirname, None)
+        else :
+            self._dirs[dirname] = (dirstat, (markers, names))
+
+    def settle(self, dirname, dirstat, markers) :
+        # The dirstat of a directory just modified, once no later change can
+        # share its mtime, if it holds markers and nothing else changed.
+        # None otherwise.
+        mtime = dirstat[0]
+        if mtime == int(mtime) :
+            # Whole seconds.
+            return None
+        delay = mtime + self.SUBSECOND_RACY_DELAY - time.time()
+        if delay > 0 :
+            time.sleep(delay)
+        try :
+            filenames = self._serieos.listdir(dirname)
+        except OSError :
+            return None
+        if set(filename for filename in filenames if self._is_marker(filename)) != set(filename for filename, mode in markers) :
+            return None
+        if self._serieos.dirstat(dirname) != dirstat :
+            return None
+        return dirstat
+
+    def save(self) :
+        lines = [self.HEADER]
+        for dirname in sorted(self._dirs.keys()) :
+            (mtime, ino), (markers, names) = self._dirs[dirname]
+            if '\n' in dirname or any('\n' in filename for filename, mode in markers) :
+                continue
+            lines.append('D %r %d %s' % (mtime, ino, dirname))
+            for filename, mode in markers :
+                lines.append('M %d %s' % (mode, filename))
+            for name in names :
+                lines.append('N %s' % (name,))
+        with self._serieos.open(self.FILENAME) as handle :
+            handle.write('\n'.join(lines)+'\n')
+
+class SerieJournal(object) :
+    # Lines of items appended by concurrent --journal invocations. The one
+    # holding LOCK_FILENAME (the leader) applies them, the others just
+    # append their line and exit.
+    FILENAME = '.serie-journal'
+    LOCK_FILENAME = '.serie-lock'
+
+    def __init__(self, serieos) :
+        self._serieos = serieos
+
+    def append(self, lines) :
+        self._serieos.append(self.FILENAME, ''.join(line + '\n' for line in lines))
+
+    def lock(self) :
+        return self._serieos.lock(self.LOCK_FILENAME)
+
+    def unlock(self, handle) :
+        self._serieos.unlock(handle)
+
+    def read(self) :
+        # Everything appended and not dropped yet.
+        return self._serieos.read_locked(self.FILENAME)
+
+    def drop(self, content) :
+        # Removes content, as returned by read, from the journal.
+        self._serieos.drop(self.FILENAME, len(content))
+
+    def pending(self) :
+        return len(self._serieos.read(self.FILENAME) or '') > 0
+
+class SerialExecutor(object) :
+    # Runs the SerieOs operations of WritePlan.apply one after the other.
+    def run(self, calls) :
+        # calls is a list of (function, args), all done when run returns.
+        for function, args in calls :
+            function(*args)
+
+    def close(self) :
+        pass
+
+class ThreadedExecutor(object) :
+    # Runs them on at most jobs threads, for filesystems where each
+    # operation waits on the network.
+    def __init__(self, jobs) :
+        self._pool = ThreadPool(jobs)
+
+    def run(self, calls) :
+        self._pool.map(lambda call : call[0](*call[1]), calls)
+
+    def close(self) :
+        self._pool.close()
+        self._pool.join()
+
+class WritePlan(object) :
+    # Filesystem changes needed to go from the scanned marker files to the
+    # wanted ones. Nothing is done until apply() is called.
+    S_IX = (stat.S_IXUSR|stat.S_IXGRP|stat.S_IXOTH)
+
+    def __init__(self, dirs_to_create, files, files_wanted, file_modes, chunk_keys=None) :
+        files_set = set(files)
+        files_wanted_set = set()
+        self.mkdirs = list(dirs_to_create)
+        self.creates = []
+        self.keeps = []
+        for filename in files_wanted :
+            if filename not in files_wanted_set :
+                files_wanted_set.add(filename)
+                if filename in files_set :
+                    self.keeps.append(filename)
+                else :
+                    self.creates.append(filename)
+        self.removes = [filename for filename in files if filename not in files_wanted_set]
+        # A marker replacing a removed one with the same chunk key (same
+        # directory, namespace and chunk) is renamed from it.
+        self.renames = []
+        if chunk_keys is not None :
+            removes_by_key = {}
+            for filename in self.removes :
+                key = chunk_keys.get(filename)
+                if key is not None :
+                    removes_by_key.setdefault(key, []).append(filename)
+            creates = []
+            for filename in self.creates :
+                removes = removes_by_key.get(chunk_keys.get(filename))
+                if removes :
+                    self.renames.append((removes.pop(0), filename))
+                else :
+                    creates.append(filename)
+            renamed = set(old_filename for old_filename, filename in self.renames)
+            self.creates = creates
+            self.removes = [filename for filename in self.removes if filename not in renamed]
+        # Unknown modes (None) are checked by SerieOs.remove_exec itself.
+        # Renamed markers keep the mode of the marker they replace.
+        self.exec_fixes = []
+        for old_filename, filename in [(filename, filename) for filename in self.keeps] + self.renames :
+            mode = file_modes.get(old_filename)
+            if mode is None or (mode & self.S_IX) != 0 :
+                self.exec_fixes.append((filename, mode))
+
+    def files(self) :
+        # The marker files present once the plan is applied.
+        return self.keeps + self.creates + [filename for old_filename, filename in self.renames]
+
+    def size(self) :
+        return len(self.mkdirs) + len(self.creates) + len(self.renames) + len(self.removes) + len(self.exec_fixes)
+
+    def describe(self) :
+        lines = []
+        lines += ['mkdir %s' % (dirname,) for dirname in self.mkdirs]
+        lines += ['create %s' % (filename,) for filename in self.creates]
+        lines += ['rename %s -> %s' % (old_filename, filename) for old_filename, filename in self.renames]
+        lines += ['remove %s' % (filename,) for filename in self.removes]
+        lines += ['chmod -x %s' % (filename,) for filename, mode in self.exec_fixes]
+        lines.append('plan: %d mkdir, %d create, %d rename, %d remove, %d chmod (%d operations)' % (len(self.mkdirs), len(self.creates), len(self.renames), len(self.removes), len(self.exec_fixes), self.size()))
+        return lines
+
+    def apply(self, serieos, executor=None) :
+        # Every create is done before any remove, so an interrupted apply
+        # leaves markers twice rather than not at all. Parent dirs are made
+        # before their subdirs, and markers are renamed before their mode
+        # is fixed.
+        if executor is None :
+            executor = SerialExecutor()
+        for dirname in self.mkdirs :
+            serieos.mkdir(dirname)
+        executor.run([(serieos.touch, (filename,)) for filename in self.creates] + [(serieos.rename, rename) for rename in self.renames])
+        executor.run([(serieos.unlink, (filename,)) for filename in self.removes] + [(serieos.remove_exec, exec_fix) for exec_fix in self.exec_fixes])
+
+class NamespaceView(object) :
+    # A namespace as given to the sinks by Serie.render : runs and got_all
+    # are computed on first use, once for every sink.
+    def __init__(self, namespace, namespace_state, max_value, changed=True) :
+        self.namespace = namespace
+        self.state = namespace_state
+        self.subdir = namespace_state.subdir
+        self.max_value = max_value
+        # False in watch mode for the namespaces that did not change.
+        self.changed = changed
+        self._runs = None
+        self._got_all = None
+
+    def runs(self) :
+        if self._runs is None :
+            self._runs = list(self.state.runs(1, self.max_value))
+        return self._runs
+
+    def got_all(self) :
+        if self._got_all is None :
+            states = self.state.states
+            if self._runs is None and len(states) <= self.max_value + 1 :
+                # No episode past max_value, the counts tell.
+                got = self.state.got()
+                if len(states) > 0 and states[0] & SerieState.GOT :
+                    got -= 1
+                self._got_all = got == self.max_value
+            else :
+                self._got_all = all(state & SerieState.GOT for run_start, run_end, state in self.runs())
+        return self._got_all
+
+    def is_ended(self) :
+        # The last episode is known, and is the last one shown.
+        return self.state.max == self.max_value
+
+    def number_format(self) :
+        return '%0' + str(len(str(self.max_value))) + 'd'
+
+class SinkFile(object) :
+    # Buffered output of a sink, written to a temporary file renamed over
+    # filename by commit(), so filename is never seen half written.
+    BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, serieos, filename) :
+        self._serieos = serieos
+        self._filename = filename
+        self._temp_filename = filename + '.tmp'
+        self._context = serieos.open(self._temp_filename)
+        self._handle = self._context.__enter__()
+        self._buffer = []
+        self._buffer_size = 0
+
+    def write(self, chunk) :
+        self._buffer.append(chunk)
+        self._buffer_size += len(chunk)
+        if self._buffer_size >= self.BUFFER_SIZE :
+            self.flush()
+
+    def flush(self) :
+        if len(self._buffer) > 0 :
+            try :
+                self._handle.write(''.join(self._buffer))
+            except Exception :
+                self.discard()
+                raise
+            self._buffer = []
+            self._buffer_size = 0
+
+    def commit(self) :
+        try :
+            self.flush()
+            context, self._context = self._context, None
+            context.__exit__(None, None, None)
+            self._serieos.rename(self._temp_filename, self._filename)
+        except Exception :
+            self.discard()
+            raise
+
+    def discard(self) :
+        # After an error : the temporary file is not left in the library.
+        if self._context is not None :
+            context, self._context = self._context, None
+            try :
+                context.__exit__(*sys.exc_info())
+            except Exception :
+                pass
+        try :
+            if self._serieos.fileexists(self._temp_filename) :
+                self._serieos.unlink(self._temp_filename)
+        except (IOError, OSError) :
+            pass
+
+class PlanSink(object) :
+    # Collects the marker files wanted, for WritePlan.
+    NAME = 'plan'
+
+    def __init__(self, serie) :
+        self._serie = serie
+        self.files_wanted = []
+        self.chunk_keys = {}
+
+    def section(self, title) :
+        pass
+
+    def add(self, view) :
+        serie = self._serie
+        namespace = view.namespace
+        if view.subdir is not None :
+            # The root namespace has no parent, it is linked as ''.
+            parent_namespace = serie._namespaces.parent(namespace) or ''
+            base_namespace = namespace[len(parent_namespace)+1:] if parent_namespace != '' else namespace
+            parent_subdir = serie.get_subdir(parent_namespace)
+            filename_subdir = view.subdir
+            if parent_subdir is not None :
+                if view.subdir.startswith(parent_subdir):
+                    filename_subdir = view.subdir[len(parent_subdir):].strip(os.sep)
+            filename_subdir = filename_subdir.replace(os.sep,'_')
+            filename = serie.get_prefix(parent_namespace)
+            filename += base_namespace
+            filename += '~'
+            filename += filename_subdir
+            self.files_wanted.append(filename)
+
+        if view.max_value is not None and serie._compact :
+            self.add_compact(view)
+        elif view.max_value is not None :
+            namespace_state = view.state
+            prefix = serie.get_prefix(namespace)
+            number_format = view.number_format()
+            items = [serie.STATE_BEGIN_CHARS[state] + number_format + serie.STATE_END_CHARS[state] for state in xrange(4)]
+            width = len(str(view.max_value))
+            scanned = namespace not in serie._dirty_namespaces and serie._versions.get(namespace) == namespace_state.version
+            if scanned and namespace not in serie._dirty_chunks :
+                chunks = self.iter_scanned_chunks(view, serie.split_at)
+            else :
+                chunks = self.iter_chunks(view, serie.split_at)
+            for chunk_start, chunk_end in chunks :
+                current_filename = None
+                if scanned :
+                    current_filename = self.get_scanned_chunk(view, prefix, width, chunk_start, chunk_end)
+                if current_filename is None :
+                    current_filename = prefix + ''.join([items[namespace_state.get(index)] % (index,) for index in xrange(chunk_start, chunk_end+1)])
+                    if chunk_end == namespace_state.max :
+                        if view.got_all() :
+                            current_filename += '#'
+                        else :
+                            current_filename += '+'
+                    self.chunk_keys[current_filename] = (os.path.dirname(current_filename), namespace, (chunk_start - 1) // serie.split_at)
+                self.files_wanted.append(current_filename)
+
+    def get_scanned_chunk(self, view, prefix, width, chunk_start, chunk_end) :
+        # The scanned marker of a chunk, if it is the one that would be
+        # written : the chunk did not change since scan, this marker alone
+        # holds its episodes, and has the same prefix, width, episodes and
+        # suffix (which also changes with set_max, add_link, flatten and
+        # migration). None otherwise.
+        serie = self._serie
+        chunk = (chunk_start - 1) // serie.split_at
+        if chunk in serie._dirty_chunks.get(view.namespace, ()) :
+            return None
+        filenames = serie._chunk_files.get(view.namespace, {}).get(chunk)
+        if filenames is None or len(filenames) != 1 :
+            return None
+        filename = filenames[0]
+        token = serie._tokenizer.parse(os.path.basename(filename))
+        if token.width() != width or token.start != chunk_start or token.last() != chunk_end :
+            return None
+        if not filename.startswith(prefix) or filename[len(prefix)] not in serie.STATE_BEGIN_CHARS :
+            return None
+        if chunk_end == view.state.max :
+            if filename[-1] != ('#' if view.got_all() else '+') :
+                return None
+        elif token.has_max :
+            return None
+        return filename
+
+    def add_compact(self, view) :
+        # Compact syntax : one [start..end] entry per run, NONE runs left out
+        # but the last one (it tells the highest episode), and as many
+        # entries per marker as fit in NAME_MAX. The first entry of a marker
+        # is always a range, so that compact markers are recognized by scan.
+        serie = self._serie
+        prefix = serie.get_prefix(view.namespace)
+        room = serie.NAME_MAX - len(os.path.basename(prefix)) - 1
+        runs = view.runs()
+        chunks = []
+        chunk = ''
+        for index, (run_start, run_end, state) in enumerate(runs) :
+            if state == SerieState.NONE and index < len(runs) - 1 :
+                continue
+            entry = self.get_compact_entry(run_start, run_end, state, chunk == '')
+            if chunk != '' and len(chunk) + len(entry) > room :
+                chunks.append(chunk)
+                chunk = self.get_compact_entry(run_start, run_end, state, True)
+            else :
+                chunk += entry
+        chunks.append(chunk)
+        if view.is_ended() :
+            chunks[-1] += '#' if view.got_all() else '+'
+        for ordinal, chunk in enumerate(chunks) :
+            filename = prefix + chunk
+            self.files_wanted.append(filename)
+            self.chunk_keys[filename] = (os.path.dirname(filename), view.namespace, ordinal)
+
+    def get_compact_entry(self, run_start, run_end, state, as_range) :
+        serie = self._serie
+        if run_start == run_end and not as_range :
+            return '%s%d%s' % (serie.STATE_BEGIN_CHARS[state], run_start, serie.STATE_END_CHARS[state])
+        return '%s%d..%d%s' % (serie.STATE_BEGIN_CHARS[state], run_start, run_end, serie.STATE_END_CHARS[state])
+
+    def iter_chunks(self, view, split_at) :
+        # Yields the (start, end) of the split_at sized chunks holding at
+        # least one episode that is not NONE, and of the last chunk. Runs of
+        # NONE episodes are skipped at once, whatever their length.
+        max_value = view.max_value
+        last_chunk_start = ((max_value - 1) // split_at) * split_at + 1
+        next_chunk_start = 1
+        for run_start, run_end, state in view.runs() :
+            if state == SerieState.NONE :
+                continue
+            first_chunk_start = max(next_chunk_start, ((run_start - 1) // split_at) * split_at + 1)
+            for chunk_start in xrange(first_chunk_start, run_end + 1, split_at) :
+                yield (chunk_start, min(chunk_start + split_at - 1, max_value))
+                next_chunk_start = chunk_start + split_at
+        if next_chunk_start <= last_chunk_start :
+            yield (last_chunk_start, max_value)
+
+    def iter_scanned_chunks(self, view, split_at) :
+        # The same chunks as iter_chunks, for a namespace that did not change
+        # since scan : its episodes all come from the scanned markers, so
+        # only their chunks are looked at.
+        max_value = view.max_value
+        last_chunk = (max_value - 1) // split_at
+        none_byte = NamespaceState._STATE_BYTES[SerieState.NONE]
+        states = view.state.states
+        chunks = set(self._serie._chunk_files.get(view.namespace, {}).keys())
+        chunks.add(last_chunk)
+        for chunk in sorted(chunks) :
+            if chunk < 0 or chunk > last_chunk :
+                continue
+            chunk_start = chunk * split_at + 1
+            chunk_end = min(chunk_start + split_at - 1, max_value)
+            chunk_states = states[chunk_start:chunk_end+1]
+            if chunk == last_chunk or chunk_states.count(none_byte) < len(chunk_states) :
+                yield (chunk_start, chunk_end)
+
+    def end(self) :
+        pass
+
+    def plan(self) :
+        # Scanned markers get the chunk key of their lowest episode, or in
+        # compact syntax, their rank in their directory and namespace.
+        serie = self._serie
+        chunk_keys = dict(self.chunk_keys)
+        firsts = {}
+        for filename in serie._files :
+            namespace = serie._file_namespaces.get(filename)
+            if namespace is not None :
+                first = serie._tokenizer.parse(os.path.basename(filename)).first()
+                if serie._compact :
+                    firsts.setdefault((os.path.dirname(filename), namespace), []).append((first, filename))
+                else :
+                    chunk_keys[filename] = (os.path.dirname(filename), namespace, (first - 1) // serie.split_at)
+        for (dirname, namespace), markers in firsts.items() :
+            for ordinal, (first, filename) in enumerate(sorted(markers)) :
+                chunk_keys[filename] = (dirname, namespace, ordinal)
+        return WritePlan(serie._dirs_to_create, serie._files, self.files_wanted, serie._file_modes, chunk_keys)
+
+class TextSink(object) :
+    # The text report, printed on the console by end().
+    NAME = 'write_text'
+    STATE_CHARS = ' [!$'
+
+    def __init__(self, serie) :
+        self._serie = serie
+        self._lines = []
+
+    def section(self, title) :
+        self._lines.append('== %s ==' % (title,))
+
+    def add(self, view) :
+        if view.max_value is None or not view.changed :
+            return
+        serie = self._serie
+        namespace_state = view.state
+        max_value = view.max_value
+        split_at = serie.split_at
+        if view.namespace != '' :
+            if view.subdir is None :
+                self._lines.append('%s:' % (view.namespace,))
+            else :
+                self._lines.append('%s (%s):' % (view.namespace, view.subdir))
+        number_format = view.number_format()
+        items = [state_char + number_format + state_char.replace('[',']') for state_char in self.STATE_CHARS]
+        if serie._collapse :
+            # One entry per run, split_at entries per line.
+            entries = [self.get_run_text(items, run_start, run_end, state) for run_start, run_end, state in view.runs()]
+            lines = [' '.join(entries[index:index+split_at]) for index in xrange(0, len(entries), split_at)]
+        else :
+            lines = []
+            for row_start in xrange(1, max_value+1, split_at) :
+                row_end = min(row_start + split_at - 1, max_value)
+                lines.append(' '.join([items[namespace_state.get(index)] % (index,) for index in xrange(row_start, row_end+1)]))
+        if view.is_ended() and len(lines) > 0 :
+            if view.got_all() :
+                lines[-1] += ' ##'
+            else :
+                lines[-1] += ' ++'
+        self._lines += lines
+        self._lines.append('')
+
+    def get_run_text(self, items, run_start, run_end, state) :
+        if run_start == run_end :
+            return items[state] % (run_start,)
+        return (items[state] % (run_start,)) + '-' + (items[state] % (run_end,))
+
+    def end(self) :
+        for line in self._lines :
+            self._serie._console.out(line)
+
+class HtmlSink(object) :
+    # serie.html, streamed to a SinkFile. In watch mode, the html of each
+    # namespace is kept in Serie._html_fragments, and only rendered again
+    # when it changed.
+    NAME = 'write_html'
+    FILENAME = 'serie.html'
+    HEADER = '<!doctype html>\n<html>\n<head><style>\nbody { background : #ffffff; }\ntable { border : 1px solid #000000; margin-bottom: 10px; }\ntd { font-family : calibri, sans-serif; font-size : 11px; font-weight : bold; width : 30px; height: 30px; text-align : center; }\n.got { border : 1px solid #000000; }\n.ungot { border : 1px solid #ffffff; }\n.seen { background-color : #f8f; }\n.unseen { }\n.complete { border : 1px solid #000000; }\n.uncomplete { border : 1px dotted #000000; }\n.namespace { font-size : 1.4em; }\n</style>\n</head>\n<body>\n'
+    FOOTER = '</body>\n</html>\n'
+    ROOT = '<h1 class="root">%s</h1>\n'
+    # Cell template by SerieState, to be completed with the number format.
+    CELLS = [
+        '<td class="ungot unseen">%s</td>',
+        '<td class="got unseen">%s</td>',
+        '<td class="ungot seen">%s</td>',
+        '<td class="got seen">%s</td>',
+        ]
+
+    def __init__(self, serie) :
+        self._serie = serie
+        self._file = None
+
+    def _open(self) :
+        if self._file is None :
+            self._file = SinkFile(self._serie._serieos, self.FILENAME)
+            self._file.write(self.HEADER)
+
+    def section(self, title) :
+        self._open()
+        self._file.write(self.ROOT % (title,))
+
+    def add(self, view) :
+        if view.max_value is None :
+            return
+        self._open()
+        fragments = self._serie._html_fragments
+        if fragments is None :
+            for chunk in self.iter_namespace(view) :
+                self._file.write(chunk)
+        else :
+            if view.changed or view.namespace not in fragments :
+                fragments[view.namespace] = ''.join(self.iter_namespace(view))
+            self._file.write(fragments[view.namespace])
+
+    def iter_namespace(self, view) :
+        # Yields one chunk per row.
+        namespace_state = view.state
+        max_value = view.max_value
+        split_at = self._serie.split_at
+        number_format = view.number_format()
+        cells = [cell % (number_format,) for cell in self.CELLS]
+        yield '<table class="%s">\n' % ('complete' if namespace_state.max is not None else 'uncomplete')
+        if view.namespace != '' :
+            yield '<tr><td class="namespace" colspan="20">%s</td></tr>\n' % (view.namespace)
+        if self._serie._collapse :
+            # One cell per run, split_at cells per row.
+            runs = view.runs()
+            for row_start in xrange(0, len(runs), split_at) :
+                row = ['<tr>']
+                for run_start, run_end, state in runs[row_start:row_start+split_at] :
+                    if run_start == run_end :
+                        row.append(cells[state] % (run_start,))
+                    else :
+                        row.append(self.CELLS[state] % ((number_format + '-' + number_format) % (run_start, run_end),))
+                row.append('</tr>\n')
+                yield ''.join(row)
+        else :
+            for row_start in xrange(1, max_value+1, split_at) :
+                row_end = min(row_start + split_at - 1, max_value)
+                row = ['<tr>']
+                for index in xrange(row_start, row_end+1) :
+                    row.append(cells[namespace_state.get(index)] % (index,))
+                row.append('</tr>\n')
+                yield ''.join(row)
+        yield '</table>\n'
+
+    def end(self) :
+        if self._file is not None :
+            self._file.write(self.FOOTER)
+            self._file.commit()
+        elif self._serie._serieos.fileexists(self.FILENAME) :
+            self._serie._serieos.unlink(self.FILENAME)
+
+class ShardedHtmlSink(HtmlSink) :
+    # serie-html/ : index.html with a summary row per namespace, linking to
+    # a page per namespace. A page is only written again when the hash of
+    # what it shows is not the one of the previous run, kept in HASHES.
+    NAME = 'write_shards'
+    DIRNAME = 'serie-html'
+    FILENAME = os.path.join(DIRNAME, 'index.html')
+    HASHES = os.path.join(DIRNAME, 'hashes')
+    HASHES_HEADER = 'serie-shards 1'
+    # Part of every page hash, to be changed with the html of the pages.
+    FORMAT = '1'
+    INDEX_HEADER = HtmlSink.HEADER.replace('</style>', '.summary td { width : auto; text-align : left; padding : 0 10px; }\n</style>')
+    INDEX_TABLE = '<table class="summary">\n'
+    SUMMARY = '<tr><td class="%s"><a href="%s">%s</a></td><td>%d got</td><td>%d seen</td><td>%d episodes</td></tr>\n'
+    BACK = '<p><a href="index.html">index</a></p>\n'
+    PAGE_RE = re.compile(r'[^A-Za-z0-9_.-]')
+
+    def __init__(self, serie) :
+        self._serie = serie
+        self._section = None
+        self._shown = False
+        self._index = [self.INDEX_HEADER, self.INDEX_TABLE]
+        self._pages = []
+        self._hashes = {}
+        self._old_hashes = self.load_hashes()
+
+    def load_hashes(self) :
+        content = self._serie._serieos.read(self.HASHES)
+        if content is None :
+            return {}
+        lines = content.split('\n')
+        if lines[0] != self.HASHES_HEADER :
+            return {}
+        return dict(line.split(' ', 1)[::-1] for line in lines[1:] if ' ' in line)
+
+    def section(self, title) :
+        self._section = title
+        self._shown = True
+        self._index += ['</table>\n', self.ROOT % (title,), self.INDEX_TABLE]
+
+    def get_page(self, view) :
+        # Filename of the page of view, ~xx standing for unsafe chars.
+        key = view.namespace
+        if self._section is not None :
+            key = '%s=%s' % (self._section, key)
+        return 'ns-' + self.PAGE_RE.sub(lambda match : '~%02x' % (ord(match.group()),), key) + '.html'
+
+    def get_hash(self, view) :
+        # What the page shows : the episodes up to max_value and the way
+        # they are rendered.
+        serie = self._serie
+        digest = hashlib.sha1()
+        digest.update(repr((self.FORMAT, view.namespace, view.max_value, view.state.max, serie._collapse, serie.split_at)).encode('utf-8'))
+        digest.update(bytes(view.state.states[1:view.max_value+1].rstrip(b'\x00')))
+        return digest.hexdigest()
+
+    def add(self, view) :
+        if view.max_value is None :
+            return
+        self._shown = True
+        namespace_state = view.state
+        page = self.get_page(view)
+        complete = 'complete' if view.is_ended() and view.got_all() else 'uncomplete'
+        self._index.append(self.SUMMARY % (complete, page, view.namespace or '(root)', namespace_state.got(), namespace_state.seen(), view.max_value))
+        if not view.changed and page in self._old_hashes :
+            # Watch mode, the namespace did not change.
+            page_hash = self._old_hashes[page]
+        else :
+            page_hash = self.get_hash(view)
+        self._hashes[page] = page_hash
+        if page_hash != self._old_hashes.get(page) or not self._serie._serieos.fileexists(os.path.join(self.DIRNAME, page)) :
+            self._pages.append((page, ''.join([self.HEADER, self.BACK] + list(self.iter_namespace(view)) + [self.FOOTER])))
+
+    def end(self) :
+        serieos = self._serie._serieos
+        if not self._shown :
+            # As serie.html, nothing is left to be kept up to date.
+            for filename in [os.path.join(self.DIRNAME, page) for page in self._old_hashes] + [self.FILENAME, self.HASHES] :
+                if serieos.fileexists(filename) :
+                    serieos.unlink(filename)
+            return
+        serieos.mkdir(self.DIRNAME)
+        self._index += ['</table>\n', self.FOOTER]
+        index = ''.join(self._index)
+        self._hashes['index.html'] = hashlib.sha1(index.encode('utf-8')).hexdigest()
+        if self._hashes['index.html'] != self._old_hashes.get('index.html') or not serieos.fileexists(self.FILENAME) :
+            self._pages.append(('index.html', index))
+        for page, content in self._pages :
+            page_file = SinkFile(serieos, os.path.join(self.DIRNAME, page))
+            page_file.write(content)
+            page_file.commit()
+        self._serie._stats.count('html_pages_written', len(self._pages))
+        for page in self._old_hashes :
+            if page not in self._hashes and serieos.fileexists(os.path.join(self.DIRNAME, page)) :
+                serieos.unlink(os.path.join(self.DIRNAME, page))
+        if self._hashes != self._old_hashes :
+            hashes_file = SinkFile(serieos, self.HASHES)
+            hashes_file.write('\n'.join([self.HASHES_HEADER] + ['%s %s' % (page_hash, page) for page, page_hash in sorted(self._hashes.items())]) + '\n')
+            hashes_file.commit()
+
+class JsonSink(object) :
+    # serie.json : {"namespaces": [...]} with one object per namespace,
+    # its episodes given as [start, end, state] runs.
+    NAME = 'write_json'
+    FILENAME = 'serie.json'
+
+    def __init__(self, serie) :
+        self._serie = serie
+        self._root = None
+        self._file = SinkFile(serie._serieos, self.FILENAME)
+        self._file.write('{"namespaces": [')
+        self._separator = '\n'
+
+    def section(self, title) :
+        self._root = title
+
+    def add(self, view) :
+        if view.max_value is None :
+            return
+        namespace_state = view.state
+        namespace = {
+            'root' : self._root,
+            'namespace' : view.namespace,
+            'subdir' : view.subdir,
+            'max' : namespace_state.max,
+            'highest' : namespace_state.highest(),
+            'got' : namespace_state.got(),
+            'seen' : namespace_state.seen(),
+            'got_unseen' : namespace_state.got_not_seen(),
+            'complete' : view.is_ended() and view.got_all(),
+            }
+        # Runs are many small lists, formatted here much faster than by
+        # json.dumps.
+        runs = ', '.join(['[%d, %d, %d]' % run for run in view.runs()])
+        self._file.write(self._separator + json.dumps(namespace, sort_keys=True)[:-1] + ', "runs": [' + runs + ']}')
+        self._separator = ',\n'
+
+    def end(self) :
+        self._file.write('\n]}\n')
+        self._file.commit()
+
+class CsvSink(object) :
+    # serie.csv : one row per run of episodes sharing the same state.
+    NAME = 'write_csv'
+    FILENAME = 'serie.csv'
+    HEADER = ['root', 'namespace', 'start', 'end', 'got', 'seen']
+
+    def __init__(self, serie) :
+        self._serie = serie
+        self._root = ''
+        self._file = SinkFile(serie._serieos, self.FILENAME)
+        self._writer = csv.writer(self._file, lineterminator='\n')
+        self._writer.writerow(self.HEADER)
+
+    def section(self, title) :
+        self._root = title
+
+    def add(self, view) :
+        if view.max_value is None :
+            return
+        self._writer.writerows([(self._root, view.namespace, run_start, run_end, state & SerieState.GOT, (state & SerieState.SEEN) >> 1) for run_start, run_end, state in view.runs()])
+
+    def end(self) :
+        self._file.commit()
 
 class Serie(object) :
     SERIE_FILE_RE = re.compile(r'^(\@[\:\_])?([^\[\]\$\!\@\:\~0-9][^\[\]\$\!\@\:\~]*_)?(?:[\[\-\$\!][0-9]+[\]\-\$\!])+(?:[\+\#])?$')
     SERIE_ITEM_RE = re.compile(r'([\[\-\$\!])([0-9]+)[\]\-\$\!]')
     SERIE_FILE_LINK_RE = re.compile(r'^@_([^\[\]\$\!\@\:\~0-9][^\[\]\$\!\@\:\~]*)~(.*)$')
     split_at = 20
+    # Longest marker filename of the compact syntax.
+    NAME_MAX = 255
 
     NUM_RE = re.compile(r'^[0-9]+$')
     NUM_RANGE_RE = re.compile(r'^[0-9]+\-[0-9]+$')
     STATE_BEGIN_CHARS = '-[!$'
     STATE_END_CHARS = '-]!$'
-    NAMESPACE_WITH_NUM_RE = re.compile(r'^(.*?)([0-9]+)$')
+
+    # --name value (or --name=value) options, as attribute and value parser.
+    OPTIONS = {
+        '--jobs' : ('_jobs', int),
+        # Modes of markers served from the cache are not checked again.
+        '--cache' : ('_use_cache', None),
+        '--dry-run' : ('_dry_run', None),
+        '--batch' : ('_batch', str),
+        '--collapse' : ('_collapse', None),
+        '--stats' : ('_show_stats', None),
+        '--profile' : ('_profile', str),
+        '--root' : ('_roots', str),
+        '--roots' : ('_roots_file', str),
+        '--targeted' : ('_targeted', None),
+        '--journal' : ('_journal', None),
+        '--record' : ('_record', str),
+        '--replay' : ('_replay', str),
+        '--replay-latency' : ('_replay_latency', None),
+        }
+    # Options that only make sense in the process handling every root.
+    MAIN_OPTIONS = ['_roots', '_roots_file', '_show_stats', '_profile', '_batch', '_record', '_replay', '_replay_latency']
 
     def __init__(self, serieos, console) :
         self._serieos = serieos
         self._console = console
 
         self._dir = '.'
-        self._namespaces = {}
-        self._files = []
         self._write_text = False
         self._write_html = False
+        self._write_shards = False
+        self._write_json = False
+        self._write_csv = False
+        self._compact = False
+        self._targeted = False
+        self._targets = None
+        self._journal = False
+        self._record = None
+        self._replay = None
+        self._replay_latency = False
         self._new_syntax = True
+        self._jobs = 1
+        self._use_cache = False
+        self._cache = None
+        self._dry_run = False
+        self._batch = None
+        self._error_prefix = ''
+        self._html_fragments = None
+        self._collapse = False
+        self._show_stats = False
+        self._profile = None
+        self._roots = []
+        self._roots_file = None
+        self._stats = SerieStats()
+        self._tokenizer = MarkerTokenizer()
+        self.reset()
         self.debug("=> Serie.__init__", None)
 
+    def reset(self) :
+        # Forgets everything learnt by scan.
+        self._namespaces = NamespaceRegistry()
+        self._files = []
+        self._file_modes = {}
+        self._file_namespaces = {}
+        self._namespace_files = {}
+        self._dir_markers = {}
+        self._scanned_dirs = []
+        self._dirs_to_create = []
+        # Scanned markers holding episodes of each chunk of split_at
+        # episodes, by namespace and chunk, and the chunks changed since scan.
+        # A namespace whose states version is not the one known here was
+        # changed some other way, and is written again as a whole.
+        self._chunk_files = {}
+        self._dirty_chunks = {}
+        self._dirty_namespaces = set()
+        self._versions = {}
+
     def debug(self, name, value) :
         # print "%s : [%s]" % (name,value)
         # self._console.out("%s : [%s]" % (name,value))
@@ -78,124 +1798,264 @@ class Serie(object) :
 
     def error(self, message) :
         # print message
-        self._console.err(message)
+        self._console.err(self._error_prefix + message)
 
     def init_namespace(self, namespace) :
-        namespace = namespace.replace(':','_')
-        if namespace.endswith('_') :
-            raise Exception('No!')
-        namespace_num_match = self.NAMESPACE_WITH_NUM_RE.match(namespace)
-        if namespace_num_match is not None:
-            prefix, count = namespace_num_match.groups()
-            namespace = prefix+"%02d" % (int(count),)
+        namespace = self._tokenizer.normalize_namespace(namespace)
         self.debug('namespace',namespace)
-        namespace_struct = self._namespaces.setdefault(namespace,{'nums':{},'max':None,'subdir':None})
-        return namespace, namespace_struct['nums']
+        namespace_state = self._namespaces.get(namespace)
+        if namespace_state is None :
+            namespace_state = self._namespaces.add(namespace)
+        return namespace, namespace_state
 
     def set_max(self, namespace, value) :
-        self._namespaces[namespace]['max'] = value
+        self._namespaces[namespace].max = value
 
     def get_max(self, namespace) :
-        return self._namespaces[namespace]['max']
+        return self._namespaces[namespace].max
 
     def set_subdir(self, namespace, value) :
-        self._namespaces[namespace]['subdir'] = value
+        self._namespaces.set_subdir(namespace, value)
 
     def get_subdir(self, namespace) :
-        if namespace not in self._namespaces :
+        namespace_state = self._namespaces.get(namespace)
+        if namespace_state is None :
             return None
-        return self._namespaces[namespace]['subdir']
+        return namespace_state.subdir
 
     def get_namespace_by_subdir(self, subdir) :
-        for namespace in self.get_namespaces() :
-            if self.get_subdir(namespace) == subdir :
-                return namespace
-        return None
+        return self._namespaces.get_by_subdir(subdir)
 
-    def scan(self) :
-        has_old_syntax = False
-        has_new_syntax = False
+    def list_dir(self, current_dir) :
+        # Only does I/O, so it can run in a worker thread : returns every
+        # name found in current_dir, and the zero size files among them
+        # that look like markers or links, with their mode.
+        filenames = set()
+        markers = []
+        for entry in self._serieos.scandir(current_dir) :
+            filename = entry.name
+            filenames.add(filename)
+            token = self._tokenizer.parse(filename)
+            link_match = None
+            if token is None :
+                link_match = self.SERIE_FILE_LINK_RE.match(filename)
+                if link_match is None :
+                    continue
+            if entry.size() == 0:
+                markers.append((filename, token, link_match, entry.mode()))
+        return filenames, markers
+
+    def list_dir_cached(self, current_dir) :
+        if current_dir in self._dirs_to_create :
+            return set(), []
+        if self._cache is not None :
+            cached = self._cache.get(current_dir)
+            if cached is not None :
+                markers, names = cached
+                listing = []
+                for filename, mode in markers :
+                    token = self._tokenizer.parse(filename)
+                    link_match = None
+                    if token is None :
+                        link_match = self.SERIE_FILE_LINK_RE.match(filename)
+                        if link_match is None :
+                            # Not something list_dir returns, the cache is
+                            # stale : the directory is listed again.
+                            listing = None
+                            break
+                    listing.append((filename, token, link_match, mode))
+                if listing is not None :
+                    return set(names), listing
+        return self.list_dir(current_dir)
+
+    def scan(self, targets=None) :
+        # With targets (a set of namespaces), only the linked subdirs leading
+        # to them are scanned.
+        if self._use_cache or self._serieos.fileexists(SerieCache.FILENAME) :
+            self._cache = SerieCache(self._serieos, self.is_marker_name)
+            self._cache.load()
+
+        self._has_old_syntax = False
+        self._has_new_syntax = False
+        self._has_compact_syntax = False
 
         subdirs_to_parse = [ None ]
-        subdirs_parsed = []
+        subdirs_parsed = set()
+        listings = {}
+        pool = None
 
-        while len(subdirs_to_parse) > 0 :
-            current_subdir = subdirs_to_parse.pop(0)
-            if current_subdir not in subdirs_parsed :
-                if current_subdir is None :
-                    current_dir = '.'
-                else :
-                    current_dir = current_subdir
-                current_namespace = self.get_namespace_by_subdir(current_subdir)
-
-                for filename in self._serieos.listdir(current_dir) :
-                    fullfilename = filename
-                    if current_subdir is not None :
-                        fullfilename = os.path.join(current_dir, filename)
-                    size = self._serieos.filesize(fullfilename)
-                    if size == 0:
-                        self.debug('scanning file', fullfilename)
-                        self.debug('current_subdir', current_subdir)
-                        self.debug('current_namespace', current_namespace)
-
-                        if (self.SERIE_FILE_RE.match(filename) is not None) :
-                            namespace = ''
-                            if filename.startswith('@') :
-                                has_new_syntax = True
-                            else :
-                                has_old_syntax = True
-                            namespace_parts = filename.split('_')
-                            if len(namespace_parts) >= 3 :
-                                namespace = '_'.join(namespace_parts[1:-1])
-                            if current_namespace is not None :
-                                if namespace != '' :
-                                    self.debug('namespaces',[current_namespace, namespace])
-                                    namespace = '_'.join([current_namespace, namespace])
-                                else :
-                                    self.debug('namespace alone',current_namespace)
-                                    namespace = current_namespace
-                            namespace, nums = self.init_namespace(namespace)
-                            for state, num in self.SERIE_ITEM_RE.findall(namespace_parts[-1]) :
-                                #print state,num
-                                state = (self.STATE_BEGIN_CHARS.index(state))
-                                num = int(num)
-                                # print num,got
-                                if num not in nums:
-                                    nums[num] = 0
-                                nums[num] |= state
-                            if filename[-1:] in ('+','#') :
-                                self.set_max(namespace, max(nums.keys()))
-                                # print "max:",self.get_max(namespace)
-                            self._files.append(fullfilename)
+        try :
+            while len(subdirs_to_parse) > 0 :
+                current_subdir = subdirs_to_parse.pop(0)
+                if current_subdir not in subdirs_parsed :
+                    if current_subdir not in listings :
+                        if self._jobs > 1 :
+                            # Every queued subdir will be parsed, list them all at once.
+                            if pool is None :
+                                pool = ThreadPool(self._jobs)
+                            subdirs_to_list = []
+                            for subdir in [current_subdir] + subdirs_to_parse :
+                                if subdir not in subdirs_parsed and subdir not in listings and subdir not in subdirs_to_list :
+                                    subdirs_to_list.append(subdir)
+                            results = pool.map(self.list_dir_cached, [self.get_dir(subdir) for subdir in subdirs_to_list])
+                            listings.update(zip(subdirs_to_list, results))
                         else :
-                            match = self.SERIE_FILE_LINK_RE.match(filename)
-                            if match is not None :
-                                has_new_syntax = True
-
-                                namespace, subdir = match.groups()
-                                subdir = subdir.replace('_', os.sep)
-                                if current_subdir is not None :
-                                    subdir = os.path.join(current_dir, subdir)
-                                if current_namespace is not None :
-                                    namespace = '_'.join([current_namespace, namespace])
-                                namespace, nums = self.init_namespace(namespace)
-                                self.set_subdir(namespace, subdir)
-                                if (subdir not in subdirs_to_parse) and (subdir not in subdirs_parsed) :
-                                    subdirs_to_parse.append(subdir)
-                                    self._serieos.mkdir(subdir)
-                                self._files.append(fullfilename)
-                subdirs_parsed.append(current_subdir)
-
-        if has_new_syntax :
+                            listings[current_subdir] = self.list_dir_cached(self.get_dir(current_subdir))
+                    for subdir in self.parse_dir(current_subdir, listings.pop(current_subdir)) :
+                        if targets is not None and not self.leads_to(self.get_namespace_by_subdir(subdir), targets) :
+                            continue
+                        if (subdir not in subdirs_to_parse) and (subdir not in subdirs_parsed) :
+                            subdirs_to_parse.append(subdir)
+                    subdirs_parsed.add(current_subdir)
+                    self._scanned_dirs.append(self.get_dir(current_subdir))
+        finally :
+            if pool is not None :
+                pool.close()
+                pool.join()
+
+        if self._has_new_syntax :
             self._new_syntax = True
-        elif has_old_syntax :
+        elif self._has_old_syntax :
             if any(namespace != '' for namespace in self.get_namespaces()) :
                 self._new_syntax = True
             else :
                 self._new_syntax = False
         else :
             self._new_syntax = True
+        if self._has_compact_syntax :
+            self._compact = True
+
+    def leads_to(self, namespace, targets) :
+        # Whether namespace is one of targets, or a parent of one of them.
+        for target in targets :
+            while target is not None :
+                if target == namespace :
+                    return True
+                target = self._namespaces.parent(target)
+        return False
+
+    def get_dir(self, subdir) :
+        if subdir is None :
+            return '.'
+        return subdir
+
+    def get_dir_namespace(self, current_subdir) :
+        if current_subdir is None :
+            return None
+        return self.get_namespace_by_subdir(current_subdir)
+
+    def get_fullfilename(self, current_subdir, filename) :
+        if current_subdir is None :
+            return filename
+        return os.path.join(current_subdir, filename)
+
+    def parse_dir(self, current_subdir, listing) :
+        # Merges the listing of a directory into the namespaces, and returns
+        # the linked subdirs found there.
+        current_dir = self.get_dir(current_subdir)
+        current_namespace = self.get_dir_namespace(current_subdir)
+        filenames, markers = listing
+        self._dir_markers[current_dir] = set(filename for filename, token, link_match, mode in markers)
+
+        links_to_check = []
+        for filename, token, link_match, mode in markers :
+            fullfilename = self.get_fullfilename(current_subdir, filename)
+            self.debug('scanning file', fullfilename)
+            self.debug('current_subdir', current_subdir)
+            self.debug('current_namespace', current_namespace)
+
+            if token is not None :
+                if token.new_syntax :
+                    self._has_new_syntax = True
+                else :
+                    self._has_old_syntax = True
+                if len(token.ranges) > 0 :
+                    self._has_compact_syntax = True
+                namespace = self.get_marker_namespace(current_namespace, token)
+                self.apply_marker(namespace, token)
+                self.add_marker_file(fullfilename, namespace, mode)
+                self.add_marker_chunks(fullfilename, namespace, token)
+            else :
+                self._has_new_syntax = True
+
+                namespace, link_subdir = link_match.groups()
+                link_subdir = link_subdir.replace('_', os.sep)
+                subdir = link_subdir
+                if current_subdir is not None :
+                    subdir = os.path.join(current_dir, subdir)
+                if current_namespace is not None :
+                    namespace = '_'.join([current_namespace, namespace])
+                namespace, namespace_state = self.init_namespace(namespace)
+                self.set_subdir(namespace, subdir)
+                links_to_check.append((link_subdir, subdir))
+                self._files.append(fullfilename)
+                self._file_modes[fullfilename] = mode
+        # The listing already tells whether a linked subdir exists
+        # directly below current_dir, no need to ask the os again.
+        for link_subdir, subdir in links_to_check :
+            if link_subdir in filenames :
+                continue
+            if os.sep in link_subdir and self._serieos.fileexists(subdir) :
+                continue
+            if subdir not in self._dirs_to_create :
+                self._dirs_to_create.append(subdir)
+        return [subdir for link_subdir, subdir in links_to_check]
+
+    def get_marker_namespace(self, current_namespace, token) :
+        namespace = token.namespace
+        if current_namespace is not None :
+            if namespace != '' :
+                self.debug('namespaces',[current_namespace, namespace])
+                namespace = '_'.join([current_namespace, namespace])
+            else :
+                self.debug('namespace alone',current_namespace)
+                namespace = current_namespace
+        namespace, namespace_state = self.init_namespace(namespace)
+        return namespace
+
+    def apply_marker(self, namespace, token) :
+        namespace_state = self._namespaces[namespace]
+        if token.start is not None :
+            # Following episodes.
+            namespace_state.add_run(token.start, token.states)
+        else :
+            for num, state in token.items :
+                namespace_state.add(num, state)
+        for start, end, state in token.ranges :
+            namespace_state.add_range(Interval(start, end), state)
+        self._versions[namespace] = namespace_state.version
+        if token.has_max :
+            self.set_max(namespace, namespace_state.highest())
+            # print "max:",self.get_max(namespace)
+
+    def add_marker_file(self, fullfilename, namespace, mode) :
+        self._files.append(fullfilename)
+        self._file_modes[fullfilename] = mode
+        self._file_namespaces[fullfilename] = namespace
+        self._namespace_files.setdefault(namespace, []).append(fullfilename)
+
+    def add_marker_chunks(self, fullfilename, namespace, token) :
+        if len(token.ranges) > 0 :
+            # Compact markers are not split by chunk.
+            self._dirty_namespaces.add(namespace)
+            return
+        first, last = token.first(), token.last()
+        # Every chunk between the first and the last one, a marker with
+        # episodes in some of them only is written again anyway.
+        chunk_files = self._chunk_files.setdefault(namespace, {})
+        for chunk in xrange((first - 1) // self.split_at, (last - 1) // self.split_at + 1) :
+            chunk_files.setdefault(chunk, []).append(fullfilename)
 
+    def set_dirty(self, namespace, interval) :
+        chunks = self._dirty_chunks.setdefault(namespace, set())
+        chunks.update(xrange((interval.start - 1) // self.split_at, (interval.end - 1) // self.split_at + 1))
+
+    def remove_marker_file(self, fullfilename) :
+        namespace = self._file_namespaces.pop(fullfilename)
+        self._namespace_files[namespace].remove(fullfilename)
+        self._files.remove(fullfilename)
+        self._file_modes.pop(fullfilename, None)
+        return namespace
 
     def get_prefix(self, namespace) :
         subdir = self.get_subdir(namespace)
@@ -211,168 +2071,531 @@ class Serie(object) :
         return prefix
 
     def get_namespaces(self) :
-        namespaces = self._namespaces.keys()
-        return sorted(namespaces)
+        return self._namespaces.names()
 
-    def write_files(self, max_by_namespace):
-        files_to_write = []
-        files_not_to_remove = []
+    def render(self, max_by_namespace, sinks, changed=None) :
+        # Walks the namespaces once, handing each one to every sink. Nothing
+        # is committed until the sinks are ended by end_sinks.
+        for namespace, namespace_state in self._namespaces.items() :
+            view = NamespaceView(namespace, namespace_state, max_by_namespace[namespace], changed is None or namespace in changed)
+            for sink in sinks :
+                sink.add(view)
 
-        for namespace in self.get_namespaces() :
-            subdir = self.get_subdir(namespace)
-            if subdir is not None :
-                if '_' in namespace :
-                    parent_namespace, base_namespace = namespace.rsplit('_',1)
-                else :
-                    parent_namespace = ''
-                    base_namespace = namespace
-                parent_subdir = self.get_subdir(parent_namespace)
-                filename_subdir = subdir
-                if parent_subdir is not None :
-                    if subdir.startswith(parent_subdir):
-                        filename_subdir = subdir[len(parent_subdir):].strip(os.sep)
-                filename_subdir = filename_subdir.replace(os.sep,'_')
-                filename = self.get_prefix(parent_namespace)
-                filename += base_namespace
-                filename += '~'
-                filename += filename_subdir
-
-                if filename in self._files :
-                    files_not_to_remove.append(filename)
-                else :
-                    files_to_write.append(filename)
-
-            got_all = True
-            if max_by_namespace[namespace] is not None :
-                digit_count = str(len(str(max_by_namespace[namespace])))
-                current_filename = self.get_prefix(namespace)
-                all_are_none = True
-                for index in xrange(1,max_by_namespace[namespace]+1) :
-                    # print "index:",index
-                    strnum = ('%0'+digit_count+'d') % (index,)
-                    state = self._namespaces[namespace]['nums'].get(index,0)
-                    got_all = got_all and ((state & SerieState.GOT) != 0)
-                    if state != SerieState.NONE or index == max_by_namespace[namespace] :
-                        all_are_none = False
-                    current_filename += (self.STATE_BEGIN_CHARS[state]) + strnum + (self.STATE_END_CHARS[state])
-                    if index == self.get_max(namespace) :
-                        if got_all :
-                            current_filename += '#'
-                        else :
-                            current_filename += '+'
-                        all_are_none = False
-                    # print current_filename
-                    if (index%self.split_at == 0) or (index == max_by_namespace[namespace]) :
-                        if not(all_are_none) :
-                            if current_filename in self._files :
-                                files_not_to_remove.append(current_filename)
-                            else :
-                                files_to_write.append(current_filename)
-                        current_filename = self.get_prefix(namespace)
-                        all_are_none = True
-
-        for filename in files_to_write :
-            self.debug("create", filename)
-            self._serieos.touch(filename)
-
-        for filename in self._files :
-            if filename not in files_not_to_remove :
-                self.debug("remove", filename)
-                self._serieos.unlink(filename)
-            else:
-                self.debug("keep", filename)
-                self._serieos.remove_exec(filename)
+    def end_sinks(self, sinks) :
+        for sink in sinks :
+            with self._stats.phase(sink.NAME) :
+                sink.end()
 
-    def write_text(self, max_by_namespace) :
+    def get_report_sinks(self) :
+        # html, shards, json and csv are written when asked for, or to keep
+        # an existing file up to date. A dry run only prints the text, a
+        # targeted run nothing, as it only knows part of the library.
+        sinks = []
+        if self._targets is not None :
+            return sinks
+        if not self._dry_run :
+            for sink_class, wanted in [(HtmlSink, self._write_html), (ShardedHtmlSink, self._write_shards), (JsonSink, self._write_json), (CsvSink, self._write_csv)] :
+                if wanted or self._serieos.fileexists(sink_class.FILENAME) :
+                    sinks.append(sink_class(self))
         if self._write_text :
-            if any(max_by_namespace[namespace] is not None for namespace in self.get_namespaces())  :
-                for namespace in self.get_namespaces() :
-                    if max_by_namespace[namespace] is not None :
-                        got_all = True
-
-                        digit_count = str(len(str(max_by_namespace[namespace])))
-                        if namespace != '' :
-                            subdir = self.get_subdir(namespace)
-                            if subdir is None :
-                                self._console.out('%s:' % (namespace,))
-                            else :
-                                self._console.out('%s (%s):' % (namespace, subdir))
-                        line = ''
-                        for index in xrange(1,max_by_namespace[namespace]+1) :
-                            strnum = ('%0'+digit_count+'d') % (index,)
-                            state = self._namespaces[namespace]['nums'].get(index,0)
-                            got_all = got_all and ((state & SerieState.GOT) != 0)
-
-                            state_char = ' [!$'[state]
-                            state_char_end = state_char.replace('[',']')
-                            line += '%s%s%s' % (state_char, strnum, state_char_end)
-                            if (index == max_by_namespace[namespace]) or (index % self.split_at == 0) :
-                                if index == self.get_max(namespace) :
-                                    if got_all :
-                                        line += ' ##'
-                                    else :
-                                        line += ' ++'
-                                self._console.out(line)
-                                line = ''
-                            else :
-                                line += ' '
-                        self._console.out('')
-
-    def write_html(self, max_by_namespace) :
-        if self._write_html or self._serieos.fileexists('serie.html') :
-            if any(max_by_namespace[namespace] is not None for namespace in self.get_namespaces())  :
-                with self._serieos.open('serie.html') as handle :
-                    handle.write('<!doctype html>\n<html>\n<head><style>\nbody { background : #ffffff; }\ntable { border : 1px solid #000000; margin-bottom: 10px; }\ntd { font-family : calibri, sans-serif; font-size : 11px; font-weight : bold; width : 30px; height: 30px; text-align : center; }\n.got { border : 1px solid #000000; }\n.ungot { border : 1px solid #ffffff; }\n.seen { background-color : #f8f; }\n.unseen { }\n.complete { border : 1px solid #000000; }\n.uncomplete { border : 1px dotted #000000; }\n.namespace { font-size : 1.4em; }\n</style>\n</head>\n<body>\n')
-                    for namespace in self.get_namespaces() :
-                        if max_by_namespace[namespace] is not None :
-                            digit_count = str(len(str(max_by_namespace[namespace])))
-                            handle.write('<table class="%s">\n' % ('complete' if self.get_max(namespace) is not None else 'uncomplete'))
-                            if namespace != '' :
-                                handle.write('<tr><td class="namespace" colspan="20">%s</td></tr>\n' % (namespace))
-                            for index in xrange(1,max_by_namespace[namespace]+1) :
-                                if (index % self.split_at == 1) :
-                                    handle.write('<tr>')
-                                strnum = ('%0'+digit_count+'d') % (index,)
-                                state = self._namespaces[namespace]['nums'].get(index,0)
-                                # got_all = got_all and ((state & SerieState.GOT) != 0)
-                                handle.write('<td class="%s %s">%s</td>' % ('got' if state & SerieState.GOT else 'ungot','seen' if state & SerieState.SEEN else 'unseen',strnum))
-                                if (index == max_by_namespace[namespace]) or (index % self.split_at == 0) :
-                                    handle.write('</tr>\n')
-                            handle.write('</table>\n')
-                    handle.write('</body>\n</html>\n')
-            else :
-                self._serieos.unlink('serie.html')
+            sinks.append(TextSink(self))
+        return sinks
 
-    def write(self) :
+    def plan(self, max_by_namespace=None) :
+        if max_by_namespace is None :
+            max_by_namespace = self.get_max_by_namespace()
+        plan_sink = PlanSink(self)
+        self.render(max_by_namespace, [plan_sink])
+        return plan_sink.plan()
+
+    def write_reports(self, max_by_namespace, changed=None) :
+        sinks = self.get_report_sinks()
+        self.render(max_by_namespace, sinks, changed)
+        self.end_sinks(sinks)
+
+    def get_max_by_namespace(self) :
         max_by_namespace = {}
         for namespace in self.get_namespaces() :
             max_by_namespace[namespace] = self.get_max(namespace)
             if max_by_namespace[namespace] is None :
-                if len(self._namespaces[namespace]['nums']) > 0 :
-                    max_by_namespace[namespace] = max(self._namespaces[namespace]['nums'].keys())
-                else :
-                    pass
-        self.write_files(max_by_namespace)
-        self.write_html(max_by_namespace)
-        self.write_text(max_by_namespace)
+                max_by_namespace[namespace] = self._namespaces[namespace].highest()
+        return max_by_namespace
+
+    def write(self) :
+        # One walk of the namespaces feeds the marker plan and every report.
+        # Markers are written first, then the reports.
+        max_by_namespace = self.get_max_by_namespace()
+        plan_sink = PlanSink(self)
+        sinks = self.get_report_sinks()
+        with self._stats.phase('render') :
+            self.render(max_by_namespace, [plan_sink] + sinks)
+        plan = plan_sink.plan()
+        self.count_library(plan)
+        if self._dry_run :
+            for line in plan.describe() :
+                self._console.out(line)
+            self.end_sinks(sinks)
+            return
+        with self._stats.phase('write_files') :
+            executor = self.get_executor()
+            try :
+                plan.apply(self._serieos, executor)
+            finally :
+                executor.close()
+        self.end_sinks(sinks)
+        if self._cache is not None :
+            with self._stats.phase('write_cache') :
+                self.write_cache(plan.files())
+
+    def get_executor(self) :
+        if self._jobs > 1 :
+            return ThreadedExecutor(self._jobs)
+        return SerialExecutor()
+
+    def count_library(self, plan) :
+        counters = self._stats.counters
+        counters['namespaces'] = len(self._namespaces)
+        counters['episodes'] = sum(namespace_state.got() + namespace_state.counts[SerieState.SEEN] for namespace_state in self._namespaces.values())
+        counters['marker_files'] = len(plan.files())
+
+    def is_marker_name(self, name) :
+        # Markers and links, as list_dir keeps them.
+        return self._tokenizer.parse(name) is not None or self.SERIE_FILE_LINK_RE.match(name) is not None
+
+    def write_cache(self, files) :
+        markers_by_dir = dict((dirname, []) for dirname in self._scanned_dirs)
+        for filename in files :
+            dirname, basename = os.path.split(filename)
+            if not self.is_marker_name(basename) :
+                # Unprefixed links are not seen by list_dir either.
+                continue
+            mode = self._file_modes.get(filename, 0o644) & ~(stat.S_IXUSR|stat.S_IXGRP|stat.S_IXOTH)
+            markers_by_dir.setdefault(dirname or '.', []).append((basename, mode))
+        for dirname, markers in markers_by_dir.items() :
+            # Linked subdirs were created by scan or add_link if needed.
+            names = []
+            for filename, mode in markers :
+                match = self.SERIE_FILE_LINK_RE.match(filename)
+                if match is not None :
+                    names.append(match.group(2).replace('_', os.sep))
+            self._cache.set(dirname, markers, names)
+        self._cache.save()
 
     def main(self, *argv) :
+        items = self.parse_options(argv)
+        if self._replay is not None :
+            trace = self._serieos.read(self._replay)
+            try :
+                if trace is None :
+                    raise ValueError("can't read it")
+                self._serieos = ReplayingSerieOs(trace, self._replay_latency)
+            except (ValueError, SyntaxError, zlib.error) as exception :
+                self.error("Can't replay [%s] (%s)" % (self._replay, exception))
+                return
+            if len(items) == 0 :
+                # The recorded command line.
+                items = self.parse_options(self._serieos.argv)
+                self._record = None
+        recorder = None
+        if self._record is not None :
+            recorder = self._serieos = RecordingSerieOs(self._serieos, argv)
+        try :
+            if self._roots_file is not None :
+                self.add_roots_file(self._roots_file)
+            if self._show_stats :
+                self._serieos = CountingSerieOs(self._serieos, self._stats)
+            run = self.run
+            if len(self._roots) > 0 :
+                run = self.run_roots
+            elif self._journal :
+                run = self.run_journal
+            if self._profile is not None :
+                self.profile(run, items)
+            else :
+                run(items)
+        finally :
+            if recorder is not None :
+                recorder.save(self._record)
+        if self._show_stats :
+            self._console.out(self._stats.report())
+
+    def run(self, items) :
+        if items[:1] == ['watch'] :
+            self.watch(*items[1:])
+            return
+        if items[:1] == ['query'] :
+            self.scan()
+            for name in items[1:] :
+                self.query_text(name)
+            return
+        if self._targeted :
+            self._targets = self.get_targets(items)
+        with self._stats.phase('scan') :
+            self.scan(self._targets)
+        with self._stats.phase('add_items') :
+            self.add_items(*items)
+            if self._batch is not None :
+                self.add_batch(self._batch)
+        self.write()
+
+    def run_journal(self, items) :
+        # Appends the items (and the --batch lines) to the journal. The
+        # process getting the lock drains it, with one scan and write cycle
+        # for all the lines appended meanwhile, until it stays empty.
+        if items[:1] in (['watch'], ['query']) or self._dry_run :
+            self.error("Can't use watch, query or --dry-run with --journal")
+            return
+        journal = SerieJournal(self._serieos)
+        lines = [' '.join(quote(item) for item in items)]
+        if self._batch is not None :
+            content = self._serieos.read(self._batch)
+            if content is None :
+                self.error("Can't read batch [%s]" % (self._batch,))
+                return
+            lines.extend(content.splitlines())
+            self._batch = None
+        journal.append(lines)
+        while True :
+            handle = journal.lock()
+            if handle is None :
+                # The leader checks the journal again after unlocking.
+                return
+            try :
+                content = journal.read()
+                while content != '' :
+                    self.run_lines(SerieJournal.FILENAME, content.splitlines())
+                    # Only dropped once written : if the cycle fails, its
+                    # lines stay for the next leader.
+                    journal.drop(content)
+                    content = journal.read()
+            finally :
+                journal.unlock(handle)
+            if not journal.pending() :
+                return
+
+    def run_lines(self, name, lines) :
+        # One scan and write cycle for the items of every line.
+        self.reset()
+        self._write_text = self._write_html = self._write_shards = self._write_json = self._write_csv = False
+        self._stats.count('journal_cycles')
+        self._stats.count('journal_lines', len(lines))
+        self._targets = None
+        if self._targeted :
+            try :
+                self._targets = self.get_targets([item for line in lines for item in shlex.split(line, comments=True)])
+            except ValueError :
+                # Reported by add_lines.
+                pass
+        with self._stats.phase('scan') :
+            self.scan(self._targets)
+        with self._stats.phase('add_items') :
+            self.add_lines(name, lines)
+        self.write()
+
+    # Items about the whole library, which can't be targeted.
+    GLOBAL_ITEMS = ['html', 'shards', 'text', 'json', 'csv', 'm', 'migration', 'f', 'flatten', 'compact', 'expand']
+
+    def get_targets(self, items) :
+        # The namespaces changed by items, or None if items (or --batch)
+        # need the whole library.
+        if self._batch is not None :
+            return None
+        targets = set()
+        for item in items :
+            if item in self.GLOBAL_ITEMS :
+                return None
+            if '~' in item :
+                namespace = item.split('~',1)[0]
+            elif ':' in item :
+                namespace = item.rsplit(':',1)[0]
+            elif '_' in item :
+                namespace = item.rsplit('_',1)[0]
+            else :
+                namespace = ''
+            try :
+                targets.add(self._tokenizer.normalize_namespace(namespace))
+            except Exception :
+                # Left for add_item to report.
+                return None
+        return targets
+
+    # Namespace selection by query name, from the aggregates of
+    # NamespaceState only.
+    QUERIES = {
+        'unseen' : lambda namespace_state : namespace_state.got_not_seen() > 0,
+        'complete' : lambda namespace_state : namespace_state.is_complete(),
+        'incomplete' : lambda namespace_state : namespace_state.max is not None and not namespace_state.is_complete(),
+        }
+
+    def query(self, name) :
+        # The namespaces matching the query name, in sorted order.
+        if name not in self.QUERIES :
+            raise ValueError('unknown query %s, use one of %s' % (name, ', '.join(sorted(self.QUERIES.keys()))))
+        selected = self.QUERIES[name]
+        return [namespace for namespace, namespace_state in self._namespaces.items() if selected(namespace_state)]
+
+    def query_text(self, name) :
+        try :
+            namespaces = self.query(name)
+        except ValueError as exception :
+            self.error("Can't understand query [%s] (%s)" % (name, exception))
+            return
+        for namespace in namespaces :
+            namespace_state = self._namespaces[namespace]
+            line = '%s: %d got, %d seen, %d got unseen' % (namespace, namespace_state.got(), namespace_state.seen(), namespace_state.got_not_seen())
+            if namespace_state.max is not None :
+                line += ', %d episodes' % (namespace_state.max,)
+            self._console.out(line)
+
+    def add_roots_file(self, filename) :
+        content = self._serieos.read(filename)
+        if content is None :
+            self.error("Can't read [%s]" % (filename,))
+            return
+        for line in content.splitlines() :
+            line = line.strip()
+            if line != '' and not line.startswith('#') :
+                self._roots.append(line)
+
+    def get_root(self, name) :
+        # A root is named as given to --root, or by its last path element.
+        for root in self._roots :
+            if name == root or name == os.path.basename(root.rstrip(os.sep)) :
+                return root
+        return None
+
+    def route_items(self, items) :
+        # Returns the items of each root : ROOT=item goes to ROOT, unprefixed
+        # items to the only root. html, shards, text, json and csv are about
+        # the global reports, migration, flatten, compact and expand go to
+        # every root.
+        items_by_root = dict((root, []) for root in self._roots)
+        for item in items :
+            root = None
+            if '=' in item :
+                root = self.get_root(item.split('=', 1)[0])
+            if root is not None :
+                items_by_root[root].append(item.split('=', 1)[1])
+            elif item in ('html', 'shards', 'text', 'json', 'csv') :
+                self.add_item(item)
+            elif item in ('m', 'migration', 'f', 'flatten', 'compact', 'expand') or len(self._roots) == 1 :
+                for root in self._roots :
+                    items_by_root[root].append(item)
+            else :
+                self.error("Can't route [%s] (use ROOT=%s)" % (item, item))
+        return items_by_root
+
+    def run_roots(self, items) :
+        # Each root is scanned and written by run_root, in a process pool,
+        # then the global html and text reports have a section per root.
+        if items[:1] == ['watch'] or self._batch is not None or self._journal :
+            self.error("Can't use watch, --batch or --journal with --root")
+            return
+        items_by_root = self.route_items(items)
+        options = dict((attribute, getattr(self, attribute)) for attribute, parser in self.OPTIONS.values() if attribute not in self.MAIN_OPTIONS)
+        tasks = [(self._serieos.for_root(root), options, items_by_root[root]) for root in self._roots]
+        with self._stats.phase('roots') :
+            if self._serieos.multiprocess :
+                pool = multiprocessing.Pool(min(len(tasks), multiprocessing.cpu_count()))
+            else :
+                pool = ThreadPool(len(tasks))
+            try :
+                results = pool.map(run_root, tasks)
+            finally :
+                pool.close()
+                pool.join()
+        sinks = self.get_report_sinks()
+        for root, (serieos, options, root_items), (console, state) in zip(self._roots, tasks, results) :
+            console.replay(self._console, '%s: ' % (root,))
+            report = Serie(serieos, self._console)
+            report.import_state(state)
+            for sink in sinks :
+                sink.section(root)
+            report.render(report.get_max_by_namespace(), sinks)
+        self.end_sinks(sinks)
+
+    def export_state(self) :
+        return [(namespace, bytes(namespace_state.states), namespace_state.max, namespace_state.subdir) for namespace, namespace_state in self._namespaces.items()]
+
+    def import_state(self, state) :
+        for namespace, states, max_value, subdir in state :
+            namespace, namespace_state = self.init_namespace(namespace)
+            namespace_state.set_states(states)
+            namespace_state.max = max_value
+            self.set_subdir(namespace, subdir)
+
+    def profile(self, function, *args) :
+        # Writes the cProfile stats to the --profile file and, where
+        # tracemalloc exists, the biggest allocations to <file>.memory.
+        import cProfile
+        try :
+            import tracemalloc
+        except ImportError :
+            tracemalloc = None
+        profiler = cProfile.Profile()
+        if tracemalloc is not None :
+            tracemalloc.start()
+        try :
+            profiler.runcall(function, *args)
+        finally :
+            profiler.dump_stats(self._profile)
+            if tracemalloc is not None :
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+                with self._serieos.open(self._profile + '.memory') as handle :
+                    for statistic in snapshot.statistics('lineno')[:50] :
+                        handle.write((str(statistic) + '\n').encode('utf-8'))
+
+    def watch(self, *items) :
+        # Keeps the namespaces in sync with the markers created, removed or
+        # renamed by others, and renders html and text again for the
+        # namespaces that changed. Markers are only written by the first pass.
+        try :
+            watcher = self._serieos.watcher()
+        except OSError as exception :
+            self.error("Can't watch (%s)" % (exception,))
+            return
+        self._html_fragments = {}
         self.scan()
-        self.add_items(*argv)
+        self.add_items(*items)
         self.write()
+        watched = set()
+        try :
+            while True :
+                for dirname in self._scanned_dirs :
+                    if dirname not in watched :
+                        watcher.add(dirname)
+                        watched.add(dirname)
+                events = watcher.wait()
+                changed = self.refresh(events)
+                if len(changed) > 0 :
+                    self.write_reports(self.get_max_by_namespace(), changed)
+        except KeyboardInterrupt :
+            pass
+        finally :
+            watcher.close()
+
+    def refresh(self, events) :
+        # Returns the namespaces changed by the (dirname, name) events.
+        dirnames = set()
+        for dirname, name in events :
+            if self.is_marker_name(name) :
+                dirnames.add(dirname)
+        changed = set()
+        for dirname in sorted(dirnames) :
+            namespaces = self.refresh_dir(dirname)
+            if namespaces is None :
+                # Links changed, the set of directories to scan may differ.
+                self.reset()
+                self.scan()
+                self._html_fragments = {}
+                return set(self.get_namespaces())
+            changed |= namespaces
+        return changed
+
+    def refresh_dir(self, dirname) :
+        # Lists dirname again, and rebuilds the namespaces of the markers
+        # that appeared or disappeared there. Returns those namespaces, or
+        # None when a link appeared or disappeared.
+        if dirname not in self._dir_markers :
+            return set()
+        filenames, markers = self.list_dir(dirname)
+        old_markers = self._dir_markers[dirname]
+        new_markers = set(filename for filename, token, link_match, mode in markers)
+        removed = old_markers - new_markers
+        added = [marker for marker in markers if marker[0] not in old_markers]
+        if any(self.SERIE_FILE_LINK_RE.match(filename) is not None for filename in removed) :
+            return None
+        if any(link_match is not None for filename, token, link_match, mode in added) :
+            return None
+        self._dir_markers[dirname] = new_markers
+
+        current_subdir = None if dirname == '.' else dirname
+        current_namespace = self.get_dir_namespace(current_subdir)
+        changed = set()
+        for filename in removed :
+            changed.add(self.remove_marker_file(self.get_fullfilename(current_subdir, filename)))
+        for filename, token, link_match, mode in added :
+            namespace = self.get_marker_namespace(current_namespace, token)
+            self.add_marker_file(self.get_fullfilename(current_subdir, filename), namespace, mode)
+            changed.add(namespace)
+        self._dirty_namespaces |= changed
+        for namespace in changed :
+            self._namespaces[namespace].clear()
+            for fullfilename in self._namespace_files[namespace] :
+                self.apply_marker(namespace, self._tokenizer.parse(os.path.basename(fullfilename)))
+        return changed
+
+    def parse_options(self, argv) :
+        items = []
+        argv = list(argv)
+        while len(argv) > 0 :
+            arg = argv.pop(0)
+            name, value = arg, None
+            if '=' in arg :
+                name, value = arg.split('=', 1)
+            if name not in self.OPTIONS :
+                items.append(arg)
+                continue
+            attribute, parser = self.OPTIONS[name]
+            if parser is None :
+                value = True
+            else :
+                if value is None and len(argv) > 0 :
+                    value = argv.pop(0)
+                try :
+                    value = parser(value)
+                except (TypeError, ValueError) :
+                    self.error("Can't understand [%s %s]" % (name, value))
+                    continue
+            if isinstance(getattr(self, attribute), list) :
+                # Repeatable option.
+                getattr(self, attribute).append(value)
+            else :
+                setattr(self, attribute, value)
+        return items
 
     def add_items(self,*argv) :
         for item in argv :
             self.add_item(item)
 
+    def add_batch(self, filename) :
+        content = self._serieos.read(filename)
+        if content is None :
+            self.error("Can't read batch [%s]" % (filename,))
+            return
+        self.add_lines(filename, content.splitlines())
+
+    def add_lines(self, name, lines) :
+        # Each line holds items, as they would be given on the command line.
+        # A bad line is reported and skipped, the others go on.
+        for line_number, line in enumerate(lines, 1) :
+            self._error_prefix = '%s:%d: ' % (name, line_number)
+            try :
+                self.add_items(*shlex.split(line, comments=True))
+            except Exception as exception :
+                self.error("Can't apply [%s] (%s)" % (line, exception))
+        self._error_prefix = ''
+
     def add_item(self, item) :
         self.debug('item',item)
         if item == 'html' :
             self._write_html = True
+        elif item == 'shards' :
+            self._write_shards = True
         elif item == 'text' :
             self._write_text = True
+        elif item == 'json' :
+            self._write_json = True
+        elif item == 'csv' :
+            self._write_csv = True
         elif item in ('m','migration') :
             self._new_syntax = True
+        elif item == 'compact' :
+            self._new_syntax = True
+            self._compact = True
+        elif item == 'expand' :
+            self._compact = False
         elif item in ('f','flatten') :
             self.flatten()
         elif '~' in item :
@@ -388,19 +2611,20 @@ class Serie(object) :
             self.add_num_item('', item)
 
     def add_link(self, namespace, item) :
-        namespace, nums = self.init_namespace(namespace)
+        namespace, namespace_state = self.init_namespace(namespace)
         if item is not None and item != '' :
             item = item.replace('_',os.sep)
             item = item.strip(os.sep)
             self.set_subdir(namespace, item)
-            self._serieos.mkdir(item)
+            if item not in self._dirs_to_create and not self._serieos.fileexists(item) :
+                self._dirs_to_create.append(item)
 
     def add_num_item(self, namespace, item) :
-        namespace, nums = self.init_namespace(namespace)
+        namespace, namespace_state = self.init_namespace(namespace)
         if item[:1] == 'e' :
             item = item[1:]
             if item == '' :
-                self.set_max(namespace, max(nums.keys()))
+                self.set_max(namespace, namespace_state.highest())
             else :
                 self.set_max(namespace, int(item))
         else :
@@ -416,32 +2640,53 @@ class Serie(object) :
                 item = item[1:]
             if len(states) == 0 :
                 states.append(states_infos['+'])
-            item_nums = []
-            for element in item.split(",") :
-                match = self.NUM_RE.match(element)
-                if match is not None :
-                    item_nums.append(int(element))
-                else :
-                    match = self.NUM_RANGE_RE.match(element)
-                    if match is not None :
-                        start,end = map(int,element.split('-',2))
-                        if end<start :
-                            start,end = end,start
-                        item_nums = item_nums + list(xrange(start,end+1))
-                    else :
-                        self.error("Can't understand [%s]" % element)
-            for num in item_nums :
+            known = self._versions.get(namespace) == namespace_state.version
+            for interval in self.parse_intervals(item) :
+                self.set_dirty(namespace, interval)
                 for state_change, state_change_add in states :
                     if state_change_add :
-                        nums[num] = nums.get(num,SerieState.NONE) | state_change
+                        namespace_state.add_range(interval, state_change)
                     else :
-                        nums[num] = nums.get(num,SerieState.NONE) & ~state_change
+                        namespace_state.remove_range(interval, state_change)
+            if known :
+                self._versions[namespace] = namespace_state.version
+
+    def parse_intervals(self, item) :
+        intervals = []
+        for element in item.split(",") :
+            match = self.NUM_RE.match(element)
+            if match is not None :
+                intervals.append(Interval(int(element), int(element)))
+            else :
+                match = self.NUM_RANGE_RE.match(element)
+                if match is not None :
+                    start,end = map(int,element.split('-',2))
+                    intervals.append(Interval(start, end))
+                else :
+                    self.error("Can't understand [%s]" % element)
+        return intervals
 
     def flatten(self) :
         for namespace in self.get_namespaces() :
-            self._namespaces[namespace]['subdir'] = None
+            self.set_subdir(namespace, None)
+
+def run_root(task) :
+    # Scans and writes one root of --root, maybe in a worker process.
+    # Returns its BufferedConsole and the namespaces found.
+    serieos, options, items = task
+    console = BufferedConsole()
+    serie = Serie(serieos, console)
+    for attribute, value in options.items() :
+        setattr(serie, attribute, value)
+    serie._write_text = False
+    serie.scan()
+    serie.add_items(*items)
+    serie.write()
+    return console, serie.export_state()
 
 if __name__ == '__main__' :
+    # The py2exe executable is started again by the run_roots workers.
+    multiprocessing.freeze_support()
     serieos = SerieOs()
     console_exporter = ConsoleExporter()
     Serie(serieos, console_exporter).main(*(sys.argv[1:]))
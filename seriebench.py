@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import timeit
+import argparse
+import tempfile
+import threading
+from serie import Serie, SerieOs, SerieOsEntry, SerieState, MarkerTokenizer, PlanSink
+
+class NullConsole(object) :
+    def out(self, text) :
+        pass
+
+    def err(self, text) :
+        sys.stderr.write(text+'\n')
+
+    def debug(self, text) :
+        pass
+
+class MemoryFile(object) :
+    def __init__(self, directory, name) :
+        self._directory = directory
+        self._name = name
+        self._buffer = []
+
+    def __enter__(self) :
+        return self
+
+    def write(self, data) :
+        self._buffer.append(data)
+
+    def __exit__(self, *args, **kwargs) :
+        self._directory.set_file(self._name, ''.join(self._buffer))
+
+class MemoryDirectory(object) :
+    def __init__(self, ino, mtime) :
+        self.ino = ino
+        self.mtime = mtime
+        self.files = {}
+        self.modes = {}
+        self.subdirs = set()
+
+    def set_file(self, name, content, mode=0o644) :
+        if name not in self.files :
+            self.mtime = time.time()
+            self.modes[name] = mode
+        self.files[name] = content
+
+class MemorySerieOs(object) :
+    # A SerieOs keeping a whole directory tree in memory, with real
+    # directories, file contents, modes and mtimes.
+    def __init__(self) :
+        self._inos = 0
+        self._dirs = {}
+        self.mkdir('.')
+
+    def _path(self, filename) :
+        path = os.path.normpath(filename)
+        return os.path.dirname(path) or '.', os.path.basename(path)
+
+    def _dir(self, dirname) :
+        dirname = os.path.normpath(dirname)
+        if dirname not in self._dirs :
+            raise OSError(2, 'No such directory', dirname)
+        return self._dirs[dirname]
+
+    def scandir(self, dirname) :
+        directory = self._dir(dirname)
+        for name in list(directory.files.keys()) :
+            yield SerieOsEntry(name, os.path.join(dirname, name), size=len(directory.files[name]), mode=directory.modes[name])
+        for name in list(directory.subdirs) :
+            yield SerieOsEntry(name, os.path.join(dirname, name), size=4096, mode=0o755)
+
+    def listdir(self, dirname) :
+        directory = self._dir(dirname)
+        return list(directory.files.keys()) + list(directory.subdirs)
+
+    def filesize(self, filename) :
+        dirname, name = self._path(filename)
+        directory = self._dir(dirname)
+        if name in directory.subdirs :
+            return 4096
+        if name not in directory.files :
+            raise OSError(2, 'No such file', filename)
+        return len(directory.files[name])
+
+    def touch(self, filename) :
+        dirname, name = self._path(filename)
+        self._dir(dirname).set_file(name, '')
+
+    def unlink(self, filename) :
+        dirname, name = self._path(filename)
+        directory = self._dir(dirname)
+        if name not in directory.files :
+            raise OSError(2, 'No such file', filename)
+        del directory.files[name]
+        del directory.modes[name]
+        directory.mtime = time.time()
+
+    def remove_exec(self, filename, mode=None) :
+        dirname, name = self._path(filename)
+        directory = self._dir(dirname)
+        directory.modes[name] &= ~0o111
+
+    def open(self, filename) :
+        dirname, name = self._path(filename)
+        return MemoryFile(self._dir(dirname), name)
+
+    def read(self, filename) :
+        if filename == '-' :
+            return sys.stdin.read()
+        dirname, name = self._path(filename)
+        directory = self._dirs.get(os.path.normpath(dirname))
+        if directory is None :
+            return None
+        return directory.files.get(name)
+
+    def fileexists(self, filename) :
+        dirname, name = self._path(filename)
+        directory = self._dirs.get(os.path.normpath(dirname))
+        if os.path.normpath(filename) in self._dirs :
+            return True
+        return directory is not None and name in directory.files
+
+    def dirstat(self, dirname) :
+        directory = self._dirs.get(os.path.normpath(dirname))
+        if directory is None :
+            return None
+        return (directory.mtime, directory.ino)
+
+    def mkdir(self, dirname) :
+        dirname = os.path.normpath(dirname)
+        if dirname not in self._dirs :
+            if dirname != '.' :
+                parent, name = self._path(dirname)
+                self.mkdir(parent)
+                self._dirs[parent].subdirs.add(name)
+                self._dirs[parent].mtime = time.time()
+            self._inos += 1
+            self._dirs[dirname] = MemoryDirectory(self._inos, time.time())
+
+    def rename(self, filename, new_filename) :
+        dirname, name = self._path(filename)
+        directory = self._dir(dirname)
+        content = directory.files[name]
+        mode = directory.modes[name]
+        self.unlink(filename)
+        new_dirname, new_name = self._path(new_filename)
+        new_directory = self._dir(new_dirname)
+        if new_name in new_directory.files :
+            self.unlink(new_filename)
+        new_directory.set_file(new_name, content, mode)
+
+class LatencySerieOs(MemorySerieOs) :
+    # A MemorySerieOs where each mutation waits latency seconds, as on a
+    # network share. Waits overlap between threads, and every mutation is
+    # logged as (method, filename).
+    MUTATIONS = ['touch', 'unlink', 'remove_exec', 'mkdir', 'rename']
+
+    def __init__(self, latency=0.002) :
+        self.latency = 0
+        self.log = []
+        self._lock = threading.RLock()
+        MemorySerieOs.__init__(self)
+        self.latency = latency
+
+    def __getattribute__(self, name) :
+        method = object.__getattribute__(self, name)
+        if name not in LatencySerieOs.MUTATIONS :
+            return method
+        def delayed(filename, *args) :
+            time.sleep(self.latency)
+            with self._lock :
+                self.log.append((name, filename))
+                return method(filename, *args)
+        return delayed
+
+def group_name(level, index) :
+    # Letters only at the end : trailing numbers of namespaces are normalized.
+    letters = ''
+    while True :
+        letters = chr(ord('a') + index % 26) + letters
+        index //= 26
+        if index == 0 :
+            return 'l%d%s' % (level, letters)
+
+def get_groups(show_index, link_depth, link_fanout) :
+    return [group_name(level, (show_index // (link_fanout ** level)) % link_fanout) for level in range(link_depth)]
+
+def generate_library(serieos, namespaces=200, episodes=100, got_density=0.6, seen_density=0.3, link_depth=1, link_fanout=4, old_syntax_markers=20, seed=0) :
+    # Writes a synthetic library through serieos : namespaces shows of
+    # episodes episodes, a fraction of them complete, each show linked
+    # link_depth subdirs deep (link_fanout groups per level), plus
+    # old_syntax_markers unnormalized old syntax markers in the root.
+    rng = random.Random(seed)
+    serie = Serie(serieos, NullConsole())
+    serie.scan()
+    for show_index in range(namespaces) :
+        groups = get_groups(show_index, link_depth, link_fanout)
+        for level in range(link_depth) :
+            if serie.get_subdir('_'.join(groups[:level+1])) is None :
+                serie.add_link('_'.join(groups[:level+1]), '_'.join(group.upper() for group in groups[:level+1]))
+        namespace, namespace_state = serie.init_namespace('_'.join(groups + ['show%d' % (show_index,)]))
+        for num in range(1, episodes+1) :
+            state = SerieState.NONE
+            if rng.random() < got_density :
+                state |= SerieState.GOT
+            if rng.random() < seen_density :
+                state |= SerieState.SEEN
+            namespace_state.add(num, state)
+        if rng.random() < 0.3 :
+            serie.set_max(namespace, episodes)
+    serie.write()
+    num = 1
+    for index in range(old_syntax_markers) :
+        # Old syntax, and one to three episodes per marker in any order.
+        nums = [num + offset for offset in range(rng.randint(1, 3))]
+        num += len(nums)
+        rng.shuffle(nums)
+        serieos.touch(''.join('[%d]' % (value,) for value in nums))
+
+def generate_items(namespaces=200, episodes=100, link_depth=1, link_fanout=4, count=200, seed=0) :
+    # Items updating the library made by generate_library with the same
+    # parameters, as download and playback hooks would.
+    rng = random.Random(seed)
+    items = []
+    for index in range(count) :
+        show_index = rng.randrange(namespaces)
+        groups = get_groups(show_index, link_depth, link_fanout)
+        namespace = ':'.join(groups + ['show%d' % (show_index,)])
+        start = rng.randint(1, episodes)
+        end = min(episodes, start + rng.randint(0, 10))
+        items.append('%s:%s%d-%d' % (namespace, rng.choice(['', 's', '-', 'u']), start, end))
+    return items
+
+class TmpfsSerieOs(SerieOs) :
+    # The real SerieOs, working in a fresh directory (on /dev/shm if it
+    # exists), which is the current directory while the benchmark runs.
+    def __init__(self) :
+        SerieOs.__init__(self)
+        parent = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        self.root = tempfile.mkdtemp(prefix='seriebench-', dir=parent)
+        self._cwd = os.getcwd()
+        os.chdir(self.root)
+
+    def close(self) :
+        os.chdir(self._cwd)
+        shutil.rmtree(self.root)
+
+BACKENDS = {
+    'memory' : MemorySerieOs,
+    'tmpfs' : TmpfsSerieOs,
+    'latency' : LatencySerieOs,
+    }
+
+PHASES = ['scan', 'add_items', 'render', 'write_files', 'write_reports']
+
+def timed(timings, phase, function, *args) :
+    start = timeit.default_timer()
+    result = function(*args)
+    timings[phase] = timeit.default_timer() - start
+    return result
+
+def bench_backend(backend, config, repeat=3) :
+    # Best time of each phase over repeat runs, each on a fresh library.
+    best = {}
+    library_config = dict((key, config[key]) for key in ('namespaces', 'episodes', 'got_density', 'seen_density', 'link_depth', 'link_fanout', 'old_syntax_markers', 'seed'))
+    items = generate_items(config['namespaces'], config['episodes'], config['link_depth'], config['link_fanout'], config['items'], config['seed'])
+    for run in range(repeat) :
+        serieos = BACKENDS[backend]()
+        try :
+            generate_library(serieos, **library_config)
+            timings = {}
+            serie = Serie(serieos, NullConsole())
+            serie._write_html = True
+            serie._write_text = True
+            serie._write_json = True
+            serie._write_csv = True
+            serie._jobs = config['jobs']
+            timed(timings, 'scan', serie.scan)
+            timed(timings, 'add_items', serie.add_items, *items)
+            # As Serie.write : one walk for the plan and every report.
+            max_by_namespace = serie.get_max_by_namespace()
+            plan_sink = PlanSink(serie)
+            sinks = serie.get_report_sinks()
+            timed(timings, 'render', serie.render, max_by_namespace, [plan_sink] + sinks)
+            executor = serie.get_executor()
+            try :
+                timed(timings, 'write_files', plan_sink.plan().apply, serieos, executor)
+            finally :
+                executor.close()
+            timed(timings, 'write_reports', serie.end_sinks, sinks)
+        finally :
+            if hasattr(serieos, 'close') :
+                serieos.close()
+        for phase in PHASES :
+            best[phase] = min(best.get(phase, timings[phase]), timings[phase])
+    return best
+
+def make_marker_filenames(namespace_count, episode_count, split_at=Serie.split_at) :
+    filenames = []
+    digit_count = len(str(episode_count))
+    for namespace_index in range(namespace_count) :
+        prefix = '@_show%d_' % (namespace_index,)
+        for chunk_start in range(1, episode_count+1, split_at) :
+            chunk_end = min(chunk_start + split_at - 1, episode_count)
+            filename = prefix
+            for num in range(chunk_start, chunk_end+1) :
+                state = '-[!$'[num % 4]
+                filename += state + ('%0*d' % (digit_count, num)) + state.replace('[',']')
+            filenames.append(filename)
+    return filenames
+
+def parse_with_regex(filenames) :
+    # The parsing done by Serie.scan before MarkerTokenizer.
+    for filename in filenames :
+        if Serie.SERIE_FILE_RE.match(filename) is not None :
+            namespace = ''
+            namespace_parts = filename.split('_')
+            if len(namespace_parts) >= 3 :
+                namespace = '_'.join(namespace_parts[1:-1])
+            namespace = namespace.replace(':','_')
+            namespace_num_match = MarkerTokenizer.NAMESPACE_WITH_NUM_RE.match(namespace)
+            if namespace_num_match is not None:
+                prefix, count = namespace_num_match.groups()
+                namespace = prefix+"%02d" % (int(count),)
+            for state, num in Serie.SERIE_ITEM_RE.findall(namespace_parts[-1]) :
+                state = (Serie.STATE_BEGIN_CHARS.index(state))
+                num = int(num)
+
+def parse_with_tokenizer(tokenizer, filenames) :
+    for filename in filenames :
+        token = tokenizer.parse(filename)
+        if token is not None :
+            tokenizer.normalize_namespace(token.namespace)
+
+def bench_tokenizer(namespace_count=200, episode_count=100, repeat=5) :
+    filenames = make_marker_filenames(namespace_count, episode_count)
+    results = {}
+    results['regex'] = min(timeit.repeat(lambda : parse_with_regex(filenames), number=1, repeat=repeat))
+    results['tokenizer_cold'] = min(timeit.repeat(lambda : parse_with_tokenizer(MarkerTokenizer(), filenames), number=1, repeat=repeat))
+    tokenizer = MarkerTokenizer()
+    parse_with_tokenizer(tokenizer, filenames)
+    results['tokenizer_memo'] = min(timeit.repeat(lambda : parse_with_tokenizer(tokenizer, filenames), number=1, repeat=repeat))
+    return results
+
+def compare(results, baseline, threshold) :
+    # Returns a line for each timing more than threshold slower than in
+    # the baseline.
+    regressions = []
+    for group in sorted(results.keys()) :
+        if group not in baseline :
+            continue
+        for name in sorted(results[group].keys()) :
+            if name not in baseline[group] :
+                continue
+            before = baseline[group][name]
+            after = results[group][name]
+            if before > 0 and after > before * (1 + threshold) :
+                regressions.append('REGRESSION %s.%s %.2fms -> %.2fms (+%d%%)' % (group, name, before * 1000, after * 1000, int((after / before - 1) * 100)))
+    return regressions
+
+def main(argv) :
+    parser = argparse.ArgumentParser(description='Times the phases of serie.py on a synthetic library.')
+    parser.add_argument('--namespaces', type=int, default=200)
+    parser.add_argument('--episodes', type=int, default=100)
+    parser.add_argument('--got-density', type=float, default=0.6)
+    parser.add_argument('--seen-density', type=float, default=0.3)
+    parser.add_argument('--link-depth', type=int, default=1)
+    parser.add_argument('--link-fanout', type=int, default=4)
+    parser.add_argument('--old-syntax-markers', type=int, default=20)
+    parser.add_argument('--items', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--jobs', type=int, default=1, help='threads used to list dirs and apply the write plan')
+    parser.add_argument('--backend', action='append', choices=sorted(BACKENDS.keys()), help='default: memory and tmpfs')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--compare', metavar='BASELINE', help='JSON results to compare with, exits with 1 on regressions')
+    parser.add_argument('--threshold', type=float, default=0.2, help='slowdown ratio reported as a regression (default: 0.2)')
+    args = parser.parse_args(argv)
+
+    config = dict((key, value) for key, value in vars(args).items() if key not in ('backend', 'output', 'compare', 'threshold', 'repeat'))
+    results = {}
+    for backend in args.backend or ['memory', 'tmpfs'] :
+        results[backend] = bench_backend(backend, config, args.repeat)
+    results['tokenizer'] = bench_tokenizer(args.namespaces, args.episodes)
+    report = json.dumps({'config' : config, 'results' : results}, indent=2, sort_keys=True)
+    if args.output is not None :
+        with open(args.output, 'w') as handle :
+            handle.write(report + '\n')
+    else :
+        sys.stdout.write(report + '\n')
+
+    if args.compare is not None :
+        with open(args.compare) as handle :
+            baseline = json.load(handle)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for line in regressions :
+            sys.stderr.write(line + '\n')
+        if len(regressions) > 0 :
+            return 1
+    return 0
+
+if __name__ == '__main__' :
+    sys.exit(main(sys.argv[1:]))
@@ -2,8 +2,12 @@
 
 import os
 import sys
+import itertools
+import threading
+import time
+import json
 import unittest
-from serie import Serie
+from serie import Serie, SerieOsEntry, SerieState, NamespaceState, NamespaceView, NamespaceRegistry, Interval, MarkerTokenizer, LruCache, SerieCache
 
 class ConsoleExporterMock(object) :
     def __init__(self) :
@@ -31,30 +35,58 @@ class ConsoleExporterMock(object) :
         self._outs.clear()
 
 class DirMock(object) :
-    def __init__(self, dirname) :
+    clock = itertools.count(1)
+    def __init__(self, dirname, lock) :
         self._dirname = dirname
+        self._lock = lock
         self._z = set()
         self._nz = set()
+        self._modes = {}
+        self._contents = {}
+        self._subdirs = set()
+        self._stats = 0
+        self._scandirs = 0
+        self._ino = next(self.clock)
+        self._mtime = next(self.clock)
         class FileClass(object) :
-            def __init__(self, filename, z, nz) :
+            def __init__(self, dirmock, filename) :
                 self._buffer = ''
-                self._z = z
-                self._nz = nz
+                self._dirmock = dirmock
                 self._filename = filename
             def __enter__(self):
                 self._buffer = ''
+                return self
             def write(self, data) :
                 self._buffer += data
             def __exit__(self, *args, **kwargs) :
-                if len(self._buffer) == 0 :
-                    self._z.add(self._filename)
-                else :
-                    self._nz.add(self._filename)
+                dirmock = self._dirmock
+                with dirmock._lock :
+                    if not dirmock.fileexists(self._filename) :
+                        dirmock.changed()
+                    dirmock._z.discard(self._filename)
+                    dirmock._nz.discard(self._filename)
+                    if len(self._buffer) == 0 :
+                        dirmock._z.add(self._filename)
+                    else :
+                        dirmock._nz.add(self._filename)
+                    dirmock._contents[self._filename] = self._buffer
         self._fileclass = FileClass
+    def changed(self) :
+        self._mtime = next(self.clock)
     def listdir(self,dirname) :
         # print "dirname: [%s][%s]" % (self._dirname, dirname)
         return sorted(list(self._z) + list(self._nz))
+    def scandir(self,dirname) :
+        # A list, so that the entries are read under the lock.
+        self._scandirs += 1
+        entries = [SerieOsEntry(filename, os.path.join(self._dirname, filename), size=(0 if filename in self._z else 1), mode=self._modes.get(filename, 0o644)) for filename in self.listdir(dirname)]
+        return entries + [SerieOsEntry(subdir, os.path.join(self._dirname, subdir), size=4096, mode=0o755) for subdir in sorted(self._subdirs)]
+    def add_subdir(self, subdir) :
+        if subdir not in self._subdirs :
+            self.changed()
+            self._subdirs.add(subdir)
     def filesize(self, filename) :
+        self._stats += 1
         if filename in self._z :
             return 0
         if filename in self._nz :
@@ -62,57 +94,166 @@ class DirMock(object) :
         raise IOError()
     def touch(self, filename) :
         if (filename not in self._z) and (filename not in self._nz) :
+            self.changed()
             self._z.add(filename)
     def unlink(self, filename) :
+        self.changed()
+        self._modes.pop(filename, None)
+        self._contents.pop(filename, None)
         if filename in self._z :
             self._z.remove(filename)
         elif filename in self._nz :
             self._nz.remove(filename)
         else :
             raise IOError()
-    def remove_exec(self, filename):
-        pass
+    def remove_exec(self, filename, mode=None):
+        if mode is None :
+            self._stats += 1
+            mode = self._modes.get(filename, 0o644)
+        if mode & 0o111 :
+            self._modes[filename] = mode & ~0o111
+    def set_mode(self, filename, mode) :
+        self._modes[filename] = mode
+    def get_mode(self, filename) :
+        return self._modes.get(filename, 0o644)
     def open(self, filename) :
-        return self._fileclass(filename, self._z, self._nz)
+        return self._fileclass(self, filename)
+    def read(self, filename) :
+        return self._contents.get(filename)
+    def dirstat(self, dirname) :
+        return (float(self._mtime), self._ino)
     def fileexists(self, filename) : 
-        return (filename in self._z) or (filename in self._nz)
-    def mkdir(self, dirname) :
-        pass
-    def apply(self, method_name, filename):
+        return (filename in self._z) or (filename in self._nz) or (filename in self._subdirs)
+    def apply(self, method_name, filename, *args):
         # print "apply: [%s][%s][%s]" % (self._dirname, method_name, filename)
         method = getattr(self, method_name)
-        return method(filename)
+        with self._lock :
+            return method(filename, *args)
+
+class WatcherMock(object) :
+    def __init__(self, steps) :
+        self._steps = steps
+        self.dirnames = []
+        self.closed = False
+    def add(self, dirname) :
+        self.dirnames.append(dirname)
+    def wait(self) :
+        if len(self._steps) == 0 :
+            # Watch mode only ends with Ctrl-C.
+            raise KeyboardInterrupt()
+        return self._steps.pop(0)()
+    def close(self) :
+        self.closed = True
 
 class SerieOsMock(object) :
+    multiprocess = False
     def __init__(self) :
+        # Scans and roots run in threads : every change to the mock,
+        # including rename and append which are several of them, holds it.
+        self._lock = threading.RLock()
         self._dirs = {}
+        self.watch_steps = []
+        self.roots = {}
+        self.renames = []
+        self.locks = set()
+        self.read_locked_steps = []
+    def for_root(self, root) :
+        with self._lock :
+            if root not in self.roots :
+                self.roots[root] = SerieOsMock()
+            return self.roots[root]
     def _get_dirmock_filename(self, global_filename) :
         basename = os.path.basename(global_filename)
         dirname = os.path.dirname(global_filename)
         if dirname == '.' :
             dirname = ''
-        if dirname not in self._dirs :
-            self._dirs[dirname] = DirMock(dirname)
-        return self._dirs[dirname], basename
-    def apply(self, method_name, filename):
+        with self._lock :
+            if dirname not in self._dirs :
+                self._dirs[dirname] = DirMock(dirname, self._lock)
+            return self._dirs[dirname], basename
+    def apply(self, method_name, filename, *args):
         dirmock, basename = self._get_dirmock_filename(filename)
-        return dirmock.apply(method_name, basename)
+        return dirmock.apply(method_name, basename, *args)
+    def _add_dirs(self, dirname) :
+        while dirname not in ('', '.') :
+            self.apply('add_subdir', dirname)
+            dirname = os.path.dirname(dirname)
+    def stats(self) :
+        with self._lock :
+            return sum(dirmock._stats for dirmock in self._dirs.values())
+    def scandirs(self) :
+        with self._lock :
+            return sum(dirmock._scandirs for dirmock in self._dirs.values())
+    def scandir(self,dirname) :
+        return self.apply('scandir', os.path.join(dirname, '.'))
     def listdir(self,dirname) :
         return self.apply('listdir', os.path.join(dirname, '.'))
     def filesize(self, filename) :
         return self.apply('filesize', filename)
     def touch(self, filename) :
+        self._add_dirs(os.path.dirname(filename))
         return self.apply('touch', filename)
     def unlink(self, filename) :
         return self.apply('unlink', filename)
-    def remove_exec(self, filename):
-        return self.apply('remove_exec', filename)
+    def remove_exec(self, filename, mode=None):
+        return self.apply('remove_exec', filename, mode)
+    def set_mode(self, filename, mode) :
+        return self.apply('set_mode', filename, mode)
+    def get_mode(self, filename) :
+        return self.apply('get_mode', filename)
     def open(self, filename) :
+        self._add_dirs(os.path.dirname(filename))
         return self.apply('open', filename)
     def fileexists(self, filename) :
         return self.apply('fileexists', filename)
+    def read(self, filename) :
+        return self.apply('read', filename)
+    def dirstat(self, dirname) :
+        return self.apply('dirstat', os.path.join(dirname, '.'))
     def mkdir(self, dirname) :
-        return self.apply('mkdir', dirname)
+        self._add_dirs(dirname)
+    def rename(self, filename, new_filename) :
+        with self._lock :
+            self.renames.append((filename, new_filename))
+            content = self.read(filename)
+            mode = self.get_mode(filename)
+            self.unlink(filename)
+            if self.fileexists(new_filename) :
+                self.unlink(new_filename)
+            if content is None :
+                self.touch(new_filename)
+            else :
+                with self.open(new_filename) as handle :
+                    handle.write(content)
+            self.set_mode(new_filename, mode)
+    def watcher(self) :
+        self.last_watcher = WatcherMock(self.watch_steps)
+        return self.last_watcher
+    def lock(self, filename) :
+        with self._lock :
+            if filename in self.locks :
+                return None
+            self.locks.add(filename)
+            return filename
+    def unlock(self, handle) :
+        with self._lock :
+            self.locks.remove(handle)
+    def append(self, filename, data) :
+        with self._lock :
+            content = self.read(filename) or ''
+            with self.open(filename) as handle :
+                handle.write(content + data)
+    def read_locked(self, filename) :
+        content = self.read(filename) or ''
+        if len(self.read_locked_steps) > 0 :
+            # Another process running while the content is applied.
+            self.read_locked_steps.pop(0)()
+        return content
+    def drop(self, filename, size) :
+        with self._lock :
+            content = self.read(filename) or ''
+            with self.open(filename) as handle :
+                handle.write(content[size:])
 
 class TestSerie(unittest.TestCase) :
     def setUp(self) :
@@ -363,6 +504,587 @@ class TestSerie(unittest.TestCase) :
         self.assert_files([],subdir='SUB01')
         self.assert_files([],subdir='SUB002')
 
+    def test_scan_uses_listing_stats(self):
+        self.main('s1:7','5','s1~SUB01')
+        self.touch(['README'])
+        self.main('6')
+        self.assert_files(['@_-1--2--3--4-[5][6]','@_s01~SUB01','README'])
+        self.assertEqual(self._serieos.stats(), 0)
+
+    def test_remove_exec(self):
+        self.main('7')
+        self._serieos.set_mode('@_-1--2--3--4--5--6-[7]', 0o755)
+        self.main()
+        self.assert_files(['@_-1--2--3--4--5--6-[7]'])
+        self.assertEqual(self._serieos.get_mode('@_-1--2--3--4--5--6-[7]'), 0o644)
+
+    def test_jobs(self):
+        self.main('s1:7','5','s1~SUB01','s002~SUB002','s2:e10','s2:1')
+        self.main('--jobs','4','s2:3','s3~SUB01_SUB03','s3:4')
+        self.assert_files(['@_-1--2--3--4-[5]','@_s01~SUB01','@_s02~SUB002','@_s03~SUB01_SUB03'])
+        self.assert_files(['@_-1--2--3--4--5--6-[7]'],subdir='SUB01')
+        self.assert_files(['@_[01]-02-[03]-04--05--06--07--08--09--10-+'],subdir='SUB002')
+        self.assert_files(['@_-1--2--3-[4]'],subdir=os.path.join('SUB01','SUB03'))
+        self.main('--jobs=3','s3:5')
+        self.assert_files(['@_-1--2--3-[4][5]'],subdir=os.path.join('SUB01','SUB03'))
+        self.assertEqual(self._serie._jobs, 3)
+
+    def test_jobs_bad_value(self):
+        self.main('--jobs','x','7')
+        self.assert_files(['@_-1--2--3--4--5--6-[7]'])
+        self.assertEqual(self._console.errs(), ["Can't understand [--jobs x]"])
+        self._console.errs()[:] = []
+
+    def test_cache(self):
+        self.main('--cache','s1:7','5','s1~SUB01')
+        self.assert_files(['.serie-cache','@_-1--2--3--4-[5]','@_s01~SUB01'])
+        self.main()
+        scandirs = self._serieos.scandirs()
+        self.main('s1:8')
+        self.assertEqual(self._serieos.scandirs(), scandirs)
+        self.assert_files(['@_-1--2--3--4--5--6-[7][8]'],subdir='SUB01')
+        self.touch([os.path.join('SUB01','[9]')])
+        self.main()
+        self.assertEqual(self._serieos.scandirs(), scandirs+1)
+        self.assert_files(['.serie-cache','@_-1--2--3--4-[5]','@_s01~SUB01'])
+        self.assert_files(['@_-1--2--3--4--5--6-[7][8][9]'],subdir='SUB01')
+
+    def test_cache_racy(self):
+        self.main('--cache','3')
+        cache = SerieCache(self._serieos, self._serie.is_marker_name)
+        dirmock = self._serieos._dirs['']
+        # Just modified, with sub-second mtimes : stored once checked.
+        dirmock._mtime = time.time() - 0.001
+        cache.set('.', [('@_-1--2-[3]', 0o644)], [])
+        self.assertEqual(cache.get('.'), ([('@_-1--2-[3]', 0o644)], []))
+        # Not the markers found there.
+        dirmock._mtime = time.time() - 0.001
+        cache.set('.', [('@_-1--2-[4]', 0o644)], [])
+        self.assertEqual(cache.get('.'), None)
+        # Whole second mtimes.
+        dirmock._mtime = int(time.time())
+        cache.set('.', [('@_-1--2-[3]', 0o644)], [])
+        self.assertEqual(cache.get('.'), None)
+
+    def test_cache_unprefixed_link(self):
+        self.touch(['[1]'])
+        self.main('--cache','2')
+        self.main('--cache','b~SB')
+        self.assertTrue('b~SB' not in self._serieos.read('.serie-cache'))
+        self.main('--cache','3')
+        self.assert_files(['.serie-cache','[1][2][3]','b~SB'])
+        # A cache written before the fix is stale.
+        with self._serieos.open('.serie-cache') as handle :
+            handle.write(self._serieos.read('.serie-cache').replace('M 420 [1][2][3]\n', 'M 420 [1][2][3]\nM 420 b~SB\n'))
+        self.assertTrue('b~SB' in self._serieos.read('.serie-cache'))
+        scandirs = self._serieos.scandirs()
+        self.main('--cache','4')
+        self.assertEqual(self._serieos.scandirs(), scandirs + 1)
+        self.assert_files(['.serie-cache','[1][2][3][4]','b~SB'])
+
+    def test_cache_corrupt(self):
+        self.main('--cache','7')
+        with self._serieos.open('.serie-cache') as handle :
+            handle.write('serie-cache 1\nD foo\n')
+        self.main('8')
+        self.assert_files(['.serie-cache','@_-1--2--3--4--5--6-[7][8]'])
+        self.main('9')
+        self.assert_files(['.serie-cache','@_-1--2--3--4--5--6-[7][8][9]'])
+
+    def test_plan(self):
+        self.main('7','s1:5')
+        self._serie = Serie(self._serieos, self._console)
+        self._serie.scan()
+        self._serie.add_items('8','s1~SUB01')
+        plan = self._serie.plan()
+        self.assertEqual(plan.mkdirs, ['SUB01'])
+        self.assertEqual(sorted(plan.creates), ['@_s01~SUB01',os.path.join('SUB01','@_-1--2--3--4-[5]')])
+        self.assertEqual(plan.renames, [('@_-1--2--3--4--5--6-[7]','@_-1--2--3--4--5--6-[7][8]')])
+        self.assertEqual(sorted(plan.removes), ['@_s01_-1--2--3--4-[5]'])
+        self.assertEqual(plan.keeps, [])
+        self.assertEqual(plan.size(), 5)
+
+    def test_dry_run(self):
+        self.main('7')
+        self.main('--dry-run','8')
+        self.assert_files(['@_-1--2--3--4--5--6-[7]'])
+        self.assert_out([
+            'rename @_-1--2--3--4--5--6-[7] -> @_-1--2--3--4--5--6-[7][8]',
+            'plan: 0 mkdir, 0 create, 1 rename, 0 remove, 0 chmod (1 operations)',
+            ])
+
+    def test_dirty_chunks(self):
+        tokenizer = MarkerTokenizer()
+        self.assertEqual(tokenizer.parse('@_a_[08]-09-!10!$11$').width(), 2)
+        self.assertEqual(tokenizer.parse('@_a_[1][3]').width(), None)
+        self.assertEqual(tokenizer.parse('@_a_[1-').width(), None)
+        self.assertEqual(tokenizer.parse('@_a_[1][02]').width(), None)
+        self.assertEqual(tokenizer.parse('@_a_[1..3]').width(), None)
+        chunks = [''.join('[%02d]' % (num,) for num in range(1, 21)), ''.join('[%02d]' % (num,) for num in range(21, 41))]
+        last_chunk = '-41--42--43--44--45-+'
+        self.main('1-40','e45')
+        self.assert_files(['@_' + chunk for chunk in chunks] + ['@_' + last_chunk])
+        # Only the chunk of the new episode is written again, the others are
+        # kept as scanned.
+        serie = Serie(self._serieos, self._console)
+        serie.scan()
+        serie.add_items('45')
+        self.assertEqual(serie._dirty_chunks, {'' : set([2])})
+        plan = serie.plan()
+        self.assertEqual(sorted(plan.keeps), ['@_' + chunk for chunk in chunks])
+        self.assertTrue(all(any(kept is filename for filename in serie._files) for kept in plan.keeps))
+        self.assertEqual(plan.renames, [('@_' + last_chunk, '@_-41--42--43--44-[45]+')])
+        # Changed without add_items, the whole namespace is written again.
+        serie._namespaces[''].add(3, SerieState.SEEN)
+        plan = serie.plan()
+        self.assertEqual(plan.keeps, ['@_' + chunks[1]])
+        # A chunk held by two markers is written as one.
+        self.touch(['@_[05]'])
+        self.main('41')
+        self.assert_files(['@_' + chunk for chunk in chunks] + ['@_[41]-42--43--44--45-+'])
+
+    def test_shards(self):
+        def written() :
+            return sorted(filename for old_filename, filename in self._serieos.renames if filename.startswith('serie-html'))
+        self.main('a:1-3','b:1','1','shards')
+        self.assert_files(['hashes','index.html','ns-.html','ns-a.html','ns-b.html'], subdir='serie-html')
+        page = self._serieos.read(os.path.join('serie-html','ns-a.html'))
+        self.assertTrue('<tr><td class="got unseen">1</td><td class="got unseen">2</td><td class="got unseen">3</td></tr>' in page)
+        index = self._serieos.read(os.path.join('serie-html','index.html'))
+        self.assertTrue('<a href="ns-a.html">a</a></td><td>3 got</td><td>0 seen</td><td>3 episodes</td>' in index)
+        self.assertTrue('<a href="ns-.html">(root)</a>' in index)
+        self.assertEqual(self._serie._stats.counters['html_pages_written'], 4)
+        # Only the page of the namespace that changed, and the index.
+        del self._serieos.renames[:]
+        self.main('a:s2')
+        self.assertEqual(written(), [os.path.join('serie-html', filename) for filename in ['hashes','index.html','ns-a.html']])
+        del self._serieos.renames[:]
+        self.main()
+        self.assertEqual(written(), [])
+        # Pages of namespaces that are gone are removed.
+        self._serieos.unlink('@_b_[1]')
+        self.main()
+        self.assert_files(['hashes','index.html','ns-.html','ns-a.html'], subdir='serie-html')
+        self.assertEqual(self._serie.get_report_sinks()[0].get_page(NamespaceView('a b', NamespaceState(), 1)), 'ns-a~20b.html')
+        # Nothing left to show : the pages are removed, as serie.html is.
+        self._serieos.unlink('@_[1]')
+        self._serieos.unlink('@_a_[1]$2$[3]')
+        self.main()
+        self.assert_files([], subdir='serie-html')
+        self.assertEqual(self._serie.get_report_sinks(), [])
+
+    def test_record_replay(self):
+        def os_counters(serie) :
+            return dict((name, value) for name, value in serie._stats.counters.items() if name.startswith('os.'))
+        self.main('a~A','a:1-3','b:1','html')
+        self.main('--record','trace','--stats','--jobs','2','a:4','b:s1','c:1')
+        recorded = os_counters(self._serie)
+        files = self._serieos.listdir('.')
+        # Replayed in memory, from an empty library.
+        serieos = SerieOsMock()
+        with serieos.open('trace') as handle :
+            handle.write(self._serieos.read('trace'))
+        console = ConsoleExporterMock()
+        serie = Serie(serieos, console)
+        serie.main('--replay','trace','--stats')
+        self.assertEqual(os_counters(serie), recorded)
+        self.assertEqual(console.errs(), [])
+        self.assertEqual(serieos.listdir('.'), ['trace'])
+        self.assertEqual(files, ['@_a~A','@_b_$1$','@_c_[1]','serie.html','trace'])
+        # Other items make calls that are not in the trace.
+        self.assertRaises(ValueError, Serie(serieos, console).main, '--replay', 'trace', 'd~D')
+        # Roots are recorded too.
+        self._serieos.for_root('r1').touch('@_[1]')
+        self.main('--record','roots','--root','r1','--root','r2','r1=2','r2=1')
+        serie = Serie(self._serieos, console)
+        serie.main('--replay','roots')
+        self.assertEqual(console.errs(), [])
+        self.assertEqual(serie._serieos.for_root('r1').call('scandir', '.'), [('@_[1]', '@_[1]')])
+
+    def test_journal(self):
+        def follower(*argv) :
+            return lambda : Serie(self._serieos, self._console).main(*argv)
+        self.main('--journal','a:1')
+        self.assert_files(['@_a_[1]','.serie-journal'])
+        self.assertEqual(self._serie._stats.counters['journal_cycles'], 1)
+        # Lines appended while the leader applies the journal are applied by
+        # the leader in a second cycle, followers only append.
+        self._serieos.read_locked_steps = [follower('--journal','b:1'), follower('--journal','c:1','html')]
+        self.main('--journal','a:2')
+        self.assert_files(['@_a_[1][2]','@_b_[1]','@_c_[1]','.serie-journal','serie.html'])
+        self.assertEqual(self._serie._stats.counters['journal_cycles'], 3)
+        self.assertEqual(self._serie._stats.counters['journal_lines'], 3)
+        self.assertEqual(self._serieos.read('.serie-journal'), '')
+        self.assertEqual(self._serieos.locks, set())
+        # Lines appended while the lock is held elsewhere wait for its holder.
+        self._serieos.locks.add('.serie-lock')
+        self.main('--journal','d:1')
+        self.main('--journal','e:1','d:2')
+        self.assertEqual(self._serieos.read('.serie-journal'), 'd:1\ne:1 d:2\n')
+        self.assert_files(['@_a_[1][2]','@_b_[1]','@_c_[1]','.serie-journal','serie.html'])
+        self._serieos.locks.remove('.serie-lock')
+        scandirs = self._serieos.scandirs()
+        self.main('--journal')
+        self.assertEqual(self._serieos.scandirs(), scandirs + 1)
+        self.assert_files(['@_a_[1][2]','@_b_[1]','@_c_[1]','@_d_[1][2]','@_e_[1]','.serie-journal','serie.html'])
+        # Lines of a cycle that failed to write stay in the journal.
+        def failing_touch(filename) :
+            raise IOError('disk full')
+        self._serieos.touch = failing_touch
+        self.assertRaises(IOError, self.main, '--journal', 'x:1')
+        self.assertEqual(self._serieos.read('.serie-journal'), 'x:1\n')
+        self.assertEqual(self._serieos.locks, set())
+        del self._serieos.touch
+        self.main('--journal')
+        self.assertEqual(self._serieos.read('.serie-journal'), '')
+        self.assertTrue('@_x_[1]' in self._serieos.listdir('.'))
+
+    def test_targeted(self):
+        self.main('a~A','b~B','a:1','b:1','d:1','html')
+        html = self.html()
+        scandirs = dict((dirname, dirmock._scandirs) for dirname, dirmock in self._serieos._dirs.items())
+        self.main('--targeted','a:2','d:s1')
+        self.assert_files(['@_a~A','@_b~B','@_d_$1$','serie.html'])
+        self.assert_files(['@_[1][2]'], subdir='A')
+        self.assertEqual(self.html(), html)
+        self.assertEqual(self._serieos._dirs['A']._scandirs, scandirs['A'] + 1)
+        self.assertEqual(self._serieos._dirs['B']._scandirs, scandirs['B'])
+        self.assertEqual(self._serie.get_targets(['b:c:3','d~D','5']), set(['b_c','d','']))
+        self.assertEqual(self._serie.get_targets(['b:c:3','html']), None)
+
+    def test_root_link(self):
+        # The root namespace has no parent.
+        self.main('3','~X')
+        self.assert_files([])
+        self.assert_files(['@_-1--2-[3]','@_~'], subdir='X')
+
+    def test_compact(self):
+        self.main('1-480','s1-300')
+        self.assertEqual(len(self._serieos.listdir('.')), 24)
+        self.main('compact','a:e3','a:1-3')
+        self.assert_files(['@_$1..300$[301..480]','@_a_[1..3]#'])
+        self.main('500','b:'+','.join(str(num) for num in range(1, 400, 2)))
+        filenames = self._serieos.listdir('.')
+        self.assertIn('@_$1..300$[301..480][500]', filenames)
+        self.assertTrue(len(filenames) > 3)
+        self.assertTrue(all(len(filename) <= Serie.NAME_MAX for filename in filenames))
+        self.assertTrue(all(filename.startswith('@_b_[') for filename in filenames if filename.startswith('@_b')))
+        serie = Serie(self._serieos, self._console)
+        serie.scan()
+        self.assertEqual(serie.plan().size(), 0)
+        self.assertEqual([serie._namespaces['b'].get(num) for num in range(1, 6)], [1,0,1,0,1])
+        self.main('expand')
+        self.assertEqual(len([filename for filename in self._serieos.listdir('.') if not filename.startswith('@_b') and not filename.startswith('@_a')]), 25)
+
+    def test_rename(self):
+        self.touch(['[1][2]','[3]','[25]'])
+        self._serieos.set_mode('[1][2]', 0o755)
+        self.main('m','s4')
+        self.assert_files(['@_[01][02][03]!04!-05--06--07--08--09--10--11--12--13--14--15--16--17--18--19--20-','@_-21--22--23--24-[25]'])
+        self.assertEqual(sorted(self._serieos.renames), [('[1][2]','@_[01][02][03]!04!-05--06--07--08--09--10--11--12--13--14--15--16--17--18--19--20-'),('[25]','@_-21--22--23--24-[25]')])
+        self.assertEqual(self._serieos.get_mode('@_[01][02][03]!04!-05--06--07--08--09--10--11--12--13--14--15--16--17--18--19--20-'), 0o644)
+
+    def test_stats(self):
+        self.main('7')
+        self.main('--stats','text','s1:3','s2:1-2')
+        stats = json.loads(self._console.outs()[-1])
+        self.assertEqual(sorted(stats['phases'].keys()), ['add_items','render','scan','write_files','write_text'])
+        self.assertEqual(stats['counters']['os.touch'], 2)
+        self.assertEqual(stats['counters']['os.scandir'], 1)
+        # The marker already there, stat'ed by the scan.
+        self.assertEqual(stats['counters']['os.lstat'], 1)
+        self.assertTrue('os.unlink' not in stats['counters'])
+        self.assertEqual(stats['counters']['namespaces'], 3)
+        self.assertEqual(stats['counters']['episodes'], 4)
+        self.assertEqual(stats['counters']['marker_files'], 3)
+
+    def test_jobs_write(self):
+        import seriebench
+        listings = []
+        for jobs in ['1', '8']:
+            serieos = seriebench.LatencySerieOs(latency=0.001)
+            seriebench.generate_library(serieos, namespaces=10, episodes=60, link_depth=1, link_fanout=2, old_syntax_markers=0)
+            del serieos.log[:]
+            Serie(serieos, self._console).main('--jobs', jobs, *seriebench.generate_items(namespaces=10, episodes=60, link_depth=1, link_fanout=2, count=30))
+            methods = [method for method, filename in serieos.log if method in ('touch', 'unlink')]
+            self.assertTrue(len(methods) > 0)
+            self.assertEqual(methods, sorted(methods, key=lambda method : method == 'unlink'))
+            listings.append(dict((dirname, sorted(directory.files)) for dirname, directory in serieos._dirs.items()))
+        self.assertEqual(listings[0], listings[1])
+
+    def test_namespace_state(self):
+        namespace_state = NamespaceState()
+        self.assertEqual(namespace_state.highest(), None)
+        namespace_state.add(3, SerieState.GOT)
+        namespace_state.add(3, SerieState.SEEN)
+        namespace_state.remove(5, SerieState.GOT)
+        self.assertEqual(namespace_state.get(3), SerieState.GOTSEEN)
+        self.assertEqual(namespace_state.get(4), SerieState.NONE)
+        self.assertEqual(namespace_state.get(50), SerieState.NONE)
+        self.assertEqual(namespace_state.highest(), 5)
+        namespace_state.remove(3, SerieState.GOT)
+        self.assertEqual(namespace_state.get(3), SerieState.SEEN)
+
+    def test_namespace_state_counts(self):
+        namespace_state = NamespaceState()
+        namespace_state.add_range(Interval(1, 10), SerieState.GOT)
+        namespace_state.add_range(Interval(5, 12), SerieState.SEEN)
+        namespace_state.remove(2, SerieState.GOT)
+        namespace_state.add(2, SerieState.GOT)
+        namespace_state.remove_range(Interval(9, 9), SerieState.GOT)
+        for state in range(4):
+            self.assertEqual(namespace_state.counts[state], list(namespace_state.states).count(state))
+        self.assertEqual((namespace_state.got(), namespace_state.seen(), namespace_state.got_not_seen()), (9, 8, 4))
+        namespace_state.max = 8
+        self.assertTrue(namespace_state.is_complete())
+        namespace_state.max = 10
+        self.assertFalse(namespace_state.is_complete())
+
+    def test_query(self):
+        self.main('s1:1-3','s1:s1-3','s1:e3','s2:1-3','s2:s1','s2:e4','s3:1-2')
+        serie = Serie(self._serieos, self._console)
+        serie.scan()
+        self.assertEqual(serie.query('unseen'), ['s02','s03'])
+        self.assertEqual(serie.query('complete'), ['s01'])
+        self.assertEqual(serie.query('incomplete'), ['s02'])
+        self.main('query','unseen','complete','bogus')
+        self.assert_out(['s02: 3 got, 1 seen, 2 got unseen, 4 episodes','s03: 2 got, 0 seen, 2 got unseen','s01: 3 got, 3 seen, 0 got unseen, 3 episodes'])
+        self.assertEqual(self._console.errs(), ["Can't understand query [bogus] (unknown query bogus, use one of complete, incomplete, unseen)"])
+        del self._console._errs[:]
+
+    def test_namespace_registry(self):
+        registry = NamespaceRegistry()
+        for namespace in ['b', 'a_x', '', 'a']:
+            registry.add(namespace)
+        self.assertEqual(registry.names(), ['', 'a', 'a_x', 'b'])
+        self.assertEqual(registry.parent('a_x'), 'a')
+        self.assertEqual(registry.parent('a'), '')
+        self.assertEqual(registry.parent(''), None)
+        registry.set_subdir('b', 'SUB')
+        registry.set_subdir('a', 'SUB')
+        self.assertEqual(registry.get_by_subdir('SUB'), 'a')
+        registry.set_subdir('a', 'OTHER')
+        self.assertEqual(registry.get_by_subdir('SUB'), 'b')
+        self.assertEqual(registry.get_by_subdir('OTHER'), 'a')
+        self.assertEqual(registry['a'].subdir, 'OTHER')
+        registry.add('c')
+        self.assertEqual(registry.names(), ['', 'a', 'a_x', 'b', 'c'])
+
+    def test_intervals(self):
+        self._serie = Serie(self._serieos, self._console)
+        self.assertEqual(self._serie.parse_intervals('1-10,15,30-20'), [Interval(1,10),Interval(15,15),Interval(20,30)])
+        namespace_state = NamespaceState()
+        namespace_state.add_range(Interval(2,50000), SerieState.GOT)
+        namespace_state.add_range(Interval(10,20), SerieState.SEEN)
+        namespace_state.remove_range(Interval(15,40000), SerieState.GOT)
+        self.assertEqual(namespace_state.highest(), 50000)
+        self.assertEqual([namespace_state.get(num) for num in (1,2,10,14,15,20,21,40000,40001)],[0,1,3,3,2,2,0,0,1])
+
+    def test_interval_big(self):
+        self.main('+s1-20000','-5-19999')
+        self.assert_files(['@_$00001$$00002$$00003$$00004$!00005!!00006!!00007!!00008!!00009!!00010!!00011!!00012!!00013!!00014!!00015!!00016!!00017!!00018!!00019!!00020!']+['@_'+''.join('!%05d!' % (num,) for num in range(start,start+20)) for start in range(21,19981,20)]+['@_'+''.join('!%05d!' % (num,) for num in range(19981,20000))+'$20000$'])
+
+    def batch(self, lines) :
+        with self._serieos.open('batch.txt') as handle :
+            handle.write('\n'.join(lines)+'\n')
+
+    def test_batch(self):
+        self.main('7')
+        self.batch(['8','name:1-3 # downloaded','','s1~SUB01','s1:e4 s1:2','text'])
+        self.main('--batch','batch.txt','9')
+        self.assert_files(['@_-1--2--3--4--5--6-[7][8][9]','@_name_[1][2][3]','@_s01~SUB01','batch.txt'])
+        self.assert_files(['@_-1-[2]-3--4-+'],subdir='SUB01')
+        self.assertEqual(self._console.outs()[-2:], [' 1  [2]  3   4  ++', ''])
+
+    def test_batch_errors(self):
+        self.batch(['7','bad_:1','name:x','s1:ex','"unclosed','8'])
+        self.main('--batch','batch.txt')
+        self.assert_files(['@_-1--2--3--4--5--6-[7][8]','batch.txt'])
+        self.assertEqual(len(self._console.errs()), 4)
+        self.assertTrue(self._console.errs()[0].startswith('batch.txt:2: '))
+        self.assertEqual(self._console.errs()[1], "batch.txt:3: Can't understand [x]")
+        self._console.errs()[:] = []
+
+    def html(self) :
+        return self._serieos.read('serie.html')
+
+    def test_watch(self):
+        self.main('7','s1:5','s1~SUB01','html')
+        def step_marker() :
+            self.touch([os.path.join('SUB01','[9]'),'README'])
+            self.assertNotIn('<td class="got unseen">9</td>', self.html())
+            return set([('SUB01','[9]'),('.','README')])
+        def step_unlink() :
+            self._serieos.unlink('@_-1--2--3--4--5--6-[7]')
+            return set([('.','@_-1--2--3--4--5--6-[7]')])
+        def step_link() :
+            self.touch(['@_s2~SUB02',os.path.join('SUB02','[3]')])
+            return set([('.','@_s2~SUB02')])
+        def step_check() :
+            html = self.html()
+            self.assertIn('<td class="got unseen">3</td>', html)
+            self.assertIn('<td class="got unseen">9</td>', html)
+            self.assertNotIn('<td class="got unseen">7</td>', html)
+            return set()
+        self._serieos.watch_steps = [step_marker, step_unlink, step_link, step_check]
+        self.main('watch','text')
+        self.assertEqual(self._serieos.last_watcher.dirnames, ['.','SUB01','SUB02'])
+        self.assertTrue(self._serieos.last_watcher.closed)
+        self.assert_files(['@_s01~SUB01','@_s2~SUB02','README','serie.html'])
+        self.assert_files(['@_-1--2--3--4-[5]','[9]'],subdir='SUB01')
+        self.assert_out([
+            ' 1   2   3   4   5   6  [7]',
+            '',
+            's01 (SUB01):',
+            ' 1   2   3   4  [5]',
+            '',
+            's01 (SUB01):',
+            ' 1   2   3   4  [5]  6   7   8  [9]',
+            '',
+            's01 (SUB01):',
+            ' 1   2   3   4  [5]  6   7   8  [9]',
+            '',
+            's02 (SUB02):',
+            ' 1   2  [3]',
+            '',
+            ])
+
+    def test_html_write_error(self):
+        self.main('3')
+        open_file = self._serieos.open
+        def failing_open(filename) :
+            handle = open_file(filename)
+            if filename.endswith('.tmp') :
+                # Created by open, as on a disk.
+                self._serieos.touch(filename)
+                def write(data) :
+                    raise IOError(28, 'No space left on device')
+                handle.write = write
+            return handle
+        self._serieos.open = failing_open
+        self.assertRaises(IOError, self.main, '4', 'html')
+        self.assert_files(['@_-1--2-[3][4]'])
+
+    def test_html(self):
+        self.main('html','1','s2-3','e3','n:1,3','n:s2-3')
+        self.assert_files(['@_[1]!2!!3!+','@_n_[1]!2!$3$','serie.html'])
+        html = self.html()
+        self.assertTrue(html.startswith('<!doctype html>\n'))
+        self.assertIn('<table class="complete">\n<tr><td class="got unseen">1</td><td class="ungot seen">2</td><td class="ungot seen">3</td></tr>\n</table>\n', html)
+        self.assertIn('<table class="uncomplete">\n<tr><td class="namespace" colspan="20">n</td></tr>\n<tr><td class="got unseen">1</td><td class="ungot seen">2</td><td class="got seen">3</td></tr>\n</table>\n', html)
+        self.assertTrue(html.endswith('</body>\n</html>\n'))
+
+    def test_roots(self):
+        self._serieos.for_root('/media/b').touch('@_s01_[1]')
+        self.main('--root','/media/a','--root=/media/b','a=s1:3','b=s1:2','html','text')
+        self.assertEqual(sorted(self._serieos.roots['/media/a'].listdir('.')), ['@_s01_-1--2-[3]'])
+        self.assertEqual(sorted(self._serieos.roots['/media/b'].listdir('.')), ['@_s01_[1][2]'])
+        self.assert_files(['serie.html'])
+        html = self.html()
+        self.assertTrue(html.index('<h1 class="root">/media/a</h1>') < html.index('<h1 class="root">/media/b</h1>'))
+        self.assertEqual(html.count('<table class="uncomplete">'), 2)
+        self.assert_out(['== /media/a ==','s01:',' 1   2  [3]','','== /media/b ==','s01:','[1] [2]',''])
+
+    def test_roots_routing(self):
+        self._serieos.touch('roots.txt')
+        with self._serieos.open('roots.txt') as handle:
+            handle.write('# libraries\n/media/a\n\n/media/b\n')
+        self.main('--roots','roots.txt','f','s1:3')
+        self.assertEqual(self._serie._roots, ['/media/a','/media/b'])
+        self.assertEqual(self._console.errs(), ["Can't route [s1:3] (use ROOT=s1:3)"])
+        del self._console._errs[:]
+
+    def test_json_csv(self):
+        runs_calls = []
+        runs = NamespaceState.runs
+        def counted_runs(namespace_state, start, end):
+            runs_calls.append((start, end))
+            return runs(namespace_state, start, end)
+        NamespaceState.runs = counted_runs
+        try:
+            self.main('html','text','json','csv','s1:1-3','s1:s2','s1:e3','n:2')
+        finally:
+            NamespaceState.runs = runs
+        self.assertEqual(len(runs_calls), 2)
+        self.assert_files(['@_n_-1-[2]','@_s01_[1]$2$[3]#','serie.html','serie.json','serie.csv'])
+        namespaces = json.loads(self._serieos.read('serie.json'))['namespaces']
+        self.assertEqual(namespaces, [
+            {'root': None, 'namespace': 'n', 'subdir': None, 'max': None, 'highest': 2, 'got': 1, 'seen': 0, 'got_unseen': 1, 'complete': False, 'runs': [[1, 1, 0], [2, 2, 1]]},
+            {'root': None, 'namespace': 's01', 'subdir': None, 'max': 3, 'highest': 3, 'got': 3, 'seen': 1, 'got_unseen': 2, 'complete': True, 'runs': [[1, 1, 1], [2, 2, 3], [3, 3, 1]]},
+            ])
+        self.assertEqual(self._serieos.read('serie.csv'), 'root,namespace,start,end,got,seen\n,n,1,1,0,0\n,n,2,2,1,0\n,s01,1,1,1,0\n,s01,2,2,1,1\n,s01,3,3,1,0\n')
+        self.main('s1:s3')
+        self.assertIn('[2, 3, 3]', self._serieos.read('serie.json'))
+
+    def test_sparse(self):
+        self.main('3','99999')
+        self.assert_files(['@_-00001--00002-[00003]-00004--00005--00006--00007--00008--00009--00010--00011--00012--00013--00014--00015--00016--00017--00018--00019--00020-','@_'+''.join('-%05d-' % (num,) for num in range(99981,99999))+'[99999]'])
+        self.main('e100001')
+        self.assert_files(['@_-000001--000002-[000003]-000004--000005--000006--000007--000008--000009--000010--000011--000012--000013--000014--000015--000016--000017--000018--000019--000020-','@_-099981--099982--099983--099984--099985--099986--099987--099988--099989--099990--099991--099992--099993--099994--099995--099996--099997--099998-[099999]-100000-','@_-100001-+'])
+
+    def test_collapse(self):
+        self.main('1-240','s1-10','250','n:1,3,5','e255')
+        self.main('--collapse','text','html')
+        self.assert_out([
+            '$001$-$010$ [011]-[240]  241 - 249  [250]  251 - 255  ++',
+            '',
+            'n:',
+            '[1]  2  [3]  4  [5]',
+            '',
+            ])
+        self.assertIn('<tr><td class="got seen">001-010</td><td class="got unseen">011-240</td><td class="ungot unseen">241-249</td><td class="got unseen">250</td><td class="ungot unseen">251-255</td></tr>\n', self.html())
+
+    def test_tokenizer(self):
+        tokenizer = MarkerTokenizer()
+        token = tokenizer.parse('@_a_b_[1]-2-!3!$14$+')
+        self.assertEqual((token.new_syntax, token.namespace, token.items, token.has_max), (True, 'a_b', ((1,1),(2,0),(3,2),(14,3)), True))
+        token = tokenizer.parse('[7][8]')
+        self.assertEqual((token.new_syntax, token.namespace, token.items, token.has_max), (False, '', ((7,1),(8,1)), False))
+        compact_token = tokenizer.parse('@_a_[1..20]-21-!22..30!+')
+        self.assertEqual((compact_token.items, compact_token.ranges, compact_token.has_max, compact_token.first()), (((21,0),), ((1,20,1),(22,30,2)), True, 1))
+        self.assertIs(tokenizer.parse('[7][8]'), token)
+        # As written by Serie, and following episodes of several widths.
+        token = tokenizer.parse('@_a_-08-[09]!10!$11$#')
+        self.assertEqual((token.start, list(token.states), token.last(), token.items, token.has_max), (8, [0,1,2,3], 11, ((8,0),(9,1),(10,2),(11,3)), True))
+        token = tokenizer.parse('@_-9-[10]')
+        self.assertEqual((token.start, list(token.states), token.last(), token.width()), (9, [0,1], 10, None))
+        self.assertEqual(tokenizer.parse('@_[1][3]').start, None)
+        self.assertEqual(tokenizer.parse('@_[01][0a]'), None)
+        self.assertEqual(tokenizer.parse('@_s01~SUB01'), None)
+        self.assertEqual(tokenizer.parse('README'), None)
+        self.assertEqual(tokenizer.normalize_namespace('name:3'), 'name_03')
+        self.assertRaises(Exception, tokenizer.normalize_namespace, 'name_')
+
+    def test_lru_cache(self):
+        cache = LruCache(4)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('d', 4)
+        cache.set('e', 5)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), None)
+        self.assertTrue(len(cache) <= 4)
+
+    def test_bench_library(self):
+        import seriebench
+        serieos = seriebench.MemorySerieOs()
+        seriebench.generate_library(serieos, namespaces=10, episodes=30, link_depth=2, link_fanout=2, old_syntax_markers=3)
+        serie = Serie(serieos, self._console)
+        serie.scan()
+        self.assertEqual(len([namespace for namespace in serie.get_namespaces() if 'show' in namespace]), 10)
+        self.assertEqual(serie.get_subdir('l0b_l1a'), os.path.join('L0B','L1A'))
+        plan = serie.plan()
+        self.assertEqual(len(plan.renames), 1)
+        self.assertEqual(len(plan.removes), 2)
+        self.assertTrue(all(filename.startswith('[') for filename in plan.removes + [plan.renames[0][0]]))
+
+    def test_text_ended_empty(self):
+        # Ended before its first episode : no row to end.
+        self.main('3','e0','text')
+        self.assert_out([''])
+
     def test_text(self):
         self.main('s1:7','5','s1~SUB01','s002~SUB002','s2:e10','s3:4','s3:113-124,139-145,152-155','s3:s123-126')
         self.assert_files(['@_-1--2--3--4-[5]','@_s01~SUB01','@_s02~SUB002','@_s03_-001--002--003-[004]-005--006--007--008--009--010--011--012--013--014--015--016--017--018--019--020-','@_s03_-101--102--103--104--105--106--107--108--109--110--111--112-[113][114][115][116][117][118][119][120]','@_s03_[121][122]$123$$124$!125!!126!-127--128--129--130--131--132--133--134--135--136--137--138-[139][140]','@_s03_[141][142][143][144][145]-146--147--148--149--150--151-[152][153][154][155]'])